@@ -10,7 +10,7 @@ JSON API definition.
 其他的Error视为Bug，返回的错误代码为internalerror。
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 # Page类用于存储分页信息
 class Page(object):
@@ -64,6 +64,65 @@ class Page(object):
 
     __repr__ = __str__
 
+# 游标是(created_at, id)的json再做urlsafe base64，对前端来说是不透明的字符串
+def encode_cursor(created_at, id):
+    s = json.dumps([created_at, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        created_at, id = json.loads(s.decode('utf-8'))
+        return float(created_at), str(id)
+    except Exception:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
+# CursorPage用于游标分页，不需要总数，每一页的开销和翻到第几页无关
+class CursorPage(object):
+    '''
+    Cursor-based page for display pages without count and offset.
+    '''
+    # cursor: 上一页返回的next_cursor，空串表示第一页
+    # limit比page_size多1，多取的一条只用来判断是否还有下一页
+    def __init__(self, cursor='', page_size=10):
+        '''
+        Init Pagination by cursor and page_size.
+        >>> p = CursorPage('', 2)
+        >>> p.after is None
+        True
+        >>> p.limit
+        3
+        >>> items = p.paginate([dict(created_at=3.0, id='c'), dict(created_at=2.0, id='b'), dict(created_at=1.0, id='a')])
+        >>> len(items), p.has_next
+        (2, True)
+        >>> decode_cursor(p.next_cursor)
+        (2.0, 'b')
+        >>> p2 = CursorPage(p.next_cursor, 2)
+        >>> p2.after
+        (2.0, 'b')
+        >>> p2.paginate([dict(created_at=1.0, id='a')]) and p2.has_next
+        False
+        '''
+        self.cursor = cursor or ''
+        self.page_size = page_size
+        self.limit = page_size + 1
+        self.after = decode_cursor(self.cursor) if self.cursor else None
+        self.has_next = False
+        self.next_cursor = ''
+
+    def paginate(self, items):
+        if len(items) > self.page_size:
+            items = items[:self.page_size]
+            self.has_next = True
+            last = items[-1]
+            self.next_cursor = encode_cursor(last['created_at'], last['id'])
+        return items
+
+    def __str__(self):
+        return 'cursor: %s, page_size: %s, has_next: %s, next_cursor: %s' % (self.cursor, self.page_size, self.has_next, self.next_cursor)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
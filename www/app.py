@@ -9,14 +9,17 @@ async web application.
 #level设置日志的级别
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, sys, json, time
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-import orm
-from coroweb import add_routes, add_static
+import orm, encoder, assets, compress, models
+from config import configs
+from coroweb import add_routes, add_static, request_auth_level, request_page_cache, compute_etag, is_not_modified, AUTH_PUBLIC, AUTH_ADMIN
+from pagecache import FragmentCacheExtension
+import pagecache
 
 from handlers import cookie2user, COOKIE_NAME
 
@@ -27,27 +30,137 @@ middleware的用处就在于把通用的功能从每个URL处理函数中拿出
 '''
 async def logger_factory(app,handler):
     async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
+        # 静态文件的请求太多，只在debug级别记录
+        if request_auth_level(request) is None:
+            logging.debug('Request: %s %s' % (request.method, request.path))
+        else:
+            logging.info('Request: %s %s' % (request.method, request.path))
         return (await handler(request))
     return logger
 
+# 读写分离：配置了从库时，写过数据的浏览器会带上_STICKY_COOKIE，在sticky_seconds内的读都走主库
+_STICKY_COOKIE = 'awesticky'
+
+async def db_route_factory(app, handler):
+    async def db_route(request):
+        token, route = orm.begin_route(primary=bool(request.cookies.get(_STICKY_COOKIE)))
+        try:
+            r = await handler(request)
+        finally:
+            orm.end_route(token)
+        if route['wrote'] and orm.has_replicas() and isinstance(r, web.StreamResponse):
+            seconds = configs.db.get('sticky_seconds', 5)
+            r.set_cookie(_STICKY_COOKIE, '1', max_age=seconds, httponly=True)
+        return r
+    return db_route
+
 # 利用middle在处理URL之前，把cookie解析出来，并将登录用户绑定到request对象上，这样，后续的URL处理函数就可以直接拿到登录用户：    
 # day15注释：把当前用户绑定到request上，并对URL/manage/进行拦截，检查当前用户是否是管理员身份：
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
+        # 静态文件和不需要登录用户的路由直接跳过，不解析cookie也不查用户
+        level = request_auth_level(request)
+        if level is None and request.path.startswith('/manage/'):
+            level = AUTH_ADMIN
+        if level is None or level == AUTH_PUBLIC:
+            return (await handler(request))
+        logging.info('check user: %s %s' % (request.method, request.path))
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             user = await cookie2user(cookie_str)
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
+        if level == AUTH_ADMIN and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
         return (await handler(request))
     return auth    
 
+
+# 条件GET：给GET请求的正常响应加上ETag，客户端带着相同的If-None-Match(或未过期的If-Modified-Since)再来时返回304，不再重复下载
+async def conditional_factory(app, handler):
+    async def conditional(request):
+        r = await handler(request)
+        if request.method not in ('GET', 'HEAD') or not isinstance(r, web.Response) or r.status != 200 or not r.body:
+            return r
+        etag = r.headers.get('ETag')
+        if etag is None:
+            etag = compute_etag(r.body)
+            r.headers['ETag'] = etag
+        # 浏览器每次使用缓存前都要带上ETag来确认
+        if 'Cache-Control' not in r.headers:
+            r.headers['Cache-Control'] = 'no-cache'
+        if is_not_modified(request, etag, r.last_modified):
+            resp = web.Response(status=304)
+            resp.headers['ETag'] = etag
+            resp.headers['Cache-Control'] = r.headers['Cache-Control']
+            # 304要带上和200相同的Vary和ETag，compress_factory不处理非200的响应
+            if 'Vary' in r.headers:
+                resp.headers['Vary'] = r.headers['Vary']
+            # 同样，客户端缓存的是压缩版本时ETag是弱校验的
+            if configs.compress.get('enabled', True) and compress.compressible(r.content_type, len(r.body)):
+                compress.add_vary(resp.headers)
+                if compress.choose_encoding(request.headers.get('Accept-Encoding')) is not None:
+                    resp.headers['ETag'] = compress.weak_etag(etag)
+            if r.last_modified is not None:
+                resp.last_modified = r.last_modified
+            return resp
+        return r
+    return conditional
+
+# 响应压缩：按Accept-Encoding压缩足够大的HTML、JSON等响应，详见compress.py
+# 静态文件(由StaticHandler发送预压缩版本)、已经设置了Content-Encoding的和流式响应不处理
+async def compress_factory(app, handler):
+    async def compress_response(request):
+        r = await handler(request)
+        if not configs.compress.get('enabled', True) or request_auth_level(request) is None:
+            return r
+        if not isinstance(r, web.Response) or r.status != 200:
+            return r
+        if 'Content-Encoding' in r.headers or not r.body or not isinstance(r.body, bytes):
+            return r
+        if not compress.compressible(r.content_type, len(r.body)):
+            return r
+        compress.add_vary(r.headers)
+        encoding = compress.choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return r
+        size = len(r.body)
+        r.body = await compress.compress_async(r.body, encoding)
+        r.headers['Content-Encoding'] = encoding
+        etag = r.headers.get('ETag')
+        if etag is not None:
+            r.headers['ETag'] = compress.weak_etag(etag)
+        logging.debug('compress %s: %s => %s bytes (%s)' % (request.path, size, len(r.body), encoding))
+        return r
+    return compress_response
+
+# 整页缓存：只缓存匿名用户的GET请求，登录用户看到的页面带有自己的信息
+async def page_cache_factory(app, handler):
+    async def page_cache(request):
+        setting = request_page_cache(request)
+        if setting is None or request.method != 'GET' or request.__user__ is not None:
+            return (await handler(request))
+        ttl, tags = setting
+        key = pagecache.page_key(request, 'anonymous', tags)
+        page = pagecache.get_page(key)
+        if page is not None:
+            body, content_type, etag = page
+            logging.info('page cache hit: %s' % request.path_qs)
+            resp = web.Response(body=body)
+            resp.content_type = content_type
+            resp.charset = 'utf-8'
+            resp.headers['ETag'] = etag
+            return resp
+        r = await handler(request)
+        # 只缓存正常的、没有设置cookie的页面，ETag一起缓存，命中时不用再算
+        if isinstance(r, web.Response) and r.status == 200 and r.body and not r.cookies:
+            etag = compute_etag(r.body)
+            r.headers['ETag'] = etag
+            pagecache.set_page(key, (r.body, r.content_type, etag), ttl)
+        return r
+    return page_cache
 	
 '''
 可参考灰_手的回答：你可以参考我的data_factory的实现。
@@ -74,6 +187,23 @@ async def response_factory(app, handler):
         #A StreamReader instance, input stream for reading request’s BODY.官方文档中的标准返回值web.Response()的类型
         if isinstance(r, web.StreamResponse):
             return r
+        # 流式JSON：chunked编码，边从数据库读边发送
+        if isinstance(r, encoder.JsonStream):
+            resp = web.StreamResponse()
+            resp.content_type = 'application/json'
+            resp.charset = 'utf-8'
+            resp.enable_chunked_encoding()
+            chunks = r.chunks()
+            try:
+                await resp.prepare(request)
+                async for chunk in chunks:
+                    await resp.write(chunk)
+            finally:
+                # 客户端断开导致prepare或write出错时，也要立即结束迭代，归还数据库连接
+                await chunks.aclose()
+                await r.aclose()
+            await resp.write_eof()
+            return resp
         #任意的二进制数据 application/octet-stream，要加上content_type
         if isinstance(r, bytes):
             resp = web.Response(body=r)
@@ -90,8 +220,8 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                # json.dumps方法对简单数据类型encoding;  类的__dict__属性时，列出了类cls所包含的属性，包括一些类内置属性和类变量clsvar以及构造方法__init__
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                # encoder.dumps对Model、Page等对象有专门的处理，其他对象回退到__dict__，详见encoder.py
+                resp = web.Response(body=encoder.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -126,45 +256,86 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
+# 绝对时间，用在{% cache %}片段里：片段会缓存几分钟，"N分钟前"这样的相对时间缓存之后就不准了
+def datetime_full_filter(t):
+    dt = datetime.fromtimestamp(t)
+    return u'%s年%s月%s日 %02d:%02d' % (dt.year, dt.month, dt.day, dt.hour, dt.minute)
+
 # 初始化jinja2模板
+# production=True时：关闭auto_reload(不再每次get_template都去stat模板文件)，编译结果写入bytecode_cache_dir，
+# 启动时预先编译全部模板并常驻内存，之后get_template只是一次dict查找
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
+    production = kw.get('production', False)
     options = dict(
         autoescape = kw.get('autoescape', True),
         block_start_string = kw.get('block_start_string', '{%'),
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', not production),
+        # {% cache %}片段缓存，见pagecache.py
+        extensions = [FragmentCacheExtension]
     )
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
     logging.info('set jinja2 template path: %s' % path)
+    if production:
+        cache_dir = kw.get('bytecode_cache_dir', None) or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.templates_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        logging.info('set jinja2 bytecode cache: %s' % cache_dir)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+        # 不限制模板缓存的数量，所有模板都常驻内存
+        options['cache_size'] = -1
     # 在这里初始化模版配置
     env = Environment(loader=FileSystemLoader(path), **options)
     filters = kw.get('filters', None)
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    # 模板中用{{ static_url('js/vue.min.js') }}引用静态文件，开启fingerprint时得到带hash的url
+    env.globals['static_url'] = assets.static_url
+    if production:
+        compile_templates(env)
     app['__templating__'] = env
+
+# 编译(或从bytecode cache加载)全部模板，返回模板数量
+def compile_templates(env):
+    start = time.time()
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    logging.info('compiled %s templates in %.1f ms.' % (len(names), (time.time() - start) * 1000))
+    return len(names)
 		
 async def init(loop):
-    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='123456', db='awesome')
+    await orm.create_pool(loop=loop, **configs.db)
     # Day5 在app.py中加入middleware、jinja2模板和自注册的支持
     # logger_factory, response_factory是两个拦截器，init_jinja2初始化jinja2，这3个都在上方实现
     # Day10 绑定了auth_factory拦截器，用于将登录用户绑定到request对象上
+    # db_route_factory负责读写分离时的主库粘滞，要放在response_factory外面才能拿到web.Response设置cookie
+    # page_cache_factory要在auth_factory之后(需要知道是不是匿名用户)、response_factory之外(缓存的是最终的body)
+    # conditional_factory在page_cache_factory之外，缓存命中的页面同样可以返回304
+    # compress_factory在conditional_factory之外，ETag按未压缩的body计算，304不需要压缩
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, db_route_factory, compress_factory, auth_factory, conditional_factory, page_cache_factory, response_factory
     ])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter, datetime_full=datetime_full_filter), **configs.templates)
+    # 用户改名、换头像后，首页、日志页和评论片段里的作者信息也要更新(只对本进程的页面缓存有效)
+    models.on_author_refresh(lambda blog_ids: pagecache.invalidate('blogs', *['blog:%s' % i for i in blog_ids]))
     add_routes(app, 'handlers')
-    add_static(app)
+    add_static(app, **configs.static)
 
     srv = await loop.create_server(app.make_handler(),'127.0.0.1',8000)
     logging.info('Server started at http://127.0.0.1:8000...')
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete((init(loop)))
-loop.run_forever()
\ No newline at end of file
+# python app.py --compile-templates 只编译模板、写入bytecode cache，用于部署时的构建步骤
+if __name__ == '__main__':
+    if '--compile-templates' in sys.argv:
+        init_jinja2(dict(), filters=dict(datetime=datetime_filter, datetime_full=datetime_full_filter), **dict(configs.templates, production=True))
+        sys.exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete((init(loop)))
+    loop.run_forever()
\ No newline at end of file
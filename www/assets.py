@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+静态资源构建
+
+把static/下的文件复制到构建目录，同时：
+1. 生成带内容hash的文件名，例如js/vue.min.js => js/vue.min.3f2a9c1d0b.js，文件内容不变url就不变，可以让浏览器永久缓存；
+2. 对css、js等可压缩的文件预先生成.gz和.br(装了brotli时)，请求时按Accept-Encoding直接发送，不用每次压缩；
+3. 写出manifest.json(原文件名 => 带hash的文件名)，模板中用{{ static_url('js/vue.min.js') }}得到带hash的url。
+
+原文件名的副本也会保留，css中用相对路径引用的字体等文件仍然可以访问。
+
+部署时构建：python assets.py
+'''
+
+import os, json, gzip, shutil, hashlib, logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.static_build')
+MANIFEST = 'manifest.json'
+
+# 需要预压缩的文件类型，图片、woff等本身已经压缩过
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.otf', '.ttf', '.eot')
+
+# 原文件名 => 带hash的文件名，以及全部带hash的文件名，init()之后有效
+_manifest = dict()
+_hashed_names = set()
+
+def fingerprint(name, data):
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:10], ext)
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# 可压缩文件的预压缩版本：扩展名 => 压缩后的内容
+def variants(name, data):
+    if not name.endswith(COMPRESSIBLE):
+        return dict()
+    v = {'.gz': gzip.compress(data, 9)}
+    if brotli is not None:
+        v['.br'] = brotli.compress(data)
+    return v
+
+def _write_variants(path, data):
+    _write(path, data)
+    for ext, compressed in variants(path, data).items():
+        _write(path + ext, compressed)
+
+# 构建全部静态文件，返回manifest
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    logging.info('build static assets: %s => %s' % (static_dir, build_dir))
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    manifest = dict()
+    for root, dirs, files in os.walk(static_dir):
+        for fn in files:
+            src = os.path.join(root, fn)
+            name = os.path.relpath(src, static_dir).replace(os.sep, '/')
+            if name == 'README':
+                continue
+            with open(src, 'rb') as f:
+                data = f.read()
+            hashed = fingerprint(name, data)
+            _write_variants(os.path.join(build_dir, name), data)
+            _write_variants(os.path.join(build_dir, hashed), data)
+            manifest[name] = hashed
+    _write(os.path.join(build_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    logging.info('built %s static assets (brotli: %s).' % (len(manifest), brotli is not None))
+    return manifest
+
+# 按static_dir当前的内容计算manifest，不写文件
+def _source_manifest(static_dir):
+    manifest = dict()
+    for root, dirs, files in os.walk(static_dir):
+        for fn in files:
+            src = os.path.join(root, fn)
+            name = os.path.relpath(src, static_dir).replace(os.sep, '/')
+            if name == 'README':
+                continue
+            with open(src, 'rb') as f:
+                manifest[name] = fingerprint(name, f.read())
+    return manifest
+
+# 加载构建目录的manifest，没有构建过、或者源文件有增删改(比如git pull之后)时重新构建，
+# 否则会继续用旧的hash文件名发送旧内容，而浏览器又把它们当作immutable永久缓存
+def init(build_dir=BUILD_DIR, static_dir=STATIC_DIR):
+    global _manifest, _hashed_names
+    path = os.path.join(build_dir, MANIFEST)
+    manifest = None
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+        if manifest != _source_manifest(static_dir):
+            logging.info('static assets changed since last build.')
+            manifest = None
+    if manifest is None:
+        manifest = build(static_dir, build_dir)
+    _manifest = manifest
+    _hashed_names = set(_manifest.values())
+    return _manifest
+
+# 带hash的文件内容永远不会变，可以设置为immutable
+def is_fingerprinted(name):
+    return name in _hashed_names
+
+# 模板中使用：{{ static_url('js/vue.min.js') }}
+def static_url(name):
+    return '/static/%s' % _manifest.get(name, name)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+回填blogs.html_content
+
+上线html_content列之后，老数据的html_content是空串，用这个脚本分批渲染并写回：
+    python backfill.py [batch_size] [processes]
+
+用Blog.iter_all()按id顺序分批处理，每批的Markdown渲染交给进程池并行完成。中途中断可以直接重跑，已经回填的行不会再处理。
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import sys, time, asyncio
+
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+import orm
+from models import Blog
+from config import configs
+
+# 一批内的渲染交给进程池并行执行，再用一个连接批量写回
+async def render_batch(loop, executor, blogs):
+    htmls = await asyncio.gather(*[loop.run_in_executor(executor, markdown2.markdown, b.content) for b in blogs])
+    await orm.execute_many('update `blogs` set `html_content`=? where `id`=?', [[html, b.id] for b, html in zip(blogs, htmls)])
+    logging.info('backfilled %s blogs, last id: %s' % (len(blogs), blogs[-1].id))
+    return len(blogs)
+
+async def backfill(loop, batch_size=100, processes=None):
+    await orm.create_pool(loop=loop, **configs.db)
+    start = time.time()
+    total = 0
+    with ProcessPoolExecutor(processes) as executor:
+        batch = []
+        async for blog in Blog.iter_all('`html_content`=?', [''], batch_size):
+            batch.append(blog)
+            if len(batch) == batch_size:
+                total = total + await render_batch(loop, executor, batch)
+                batch = []
+        if batch:
+            total = total + await render_batch(loop, executor, batch)
+    await orm.destory_pool()
+    logging.info('backfill done: %s blogs in %.1f seconds.' % (total, time.time() - start))
+
+if __name__ == '__main__':
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backfill(loop, batch_size, processes))
+    loop.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+性能对比脚本，不需要数据库(bench_static需要本机端口8765空闲)：
+    python bench.py
+'''
+
+import timeit
+
+from models import Blog
+
+N = 100000
+
+def report(name, t, n=N):
+    print('%-40s %8.2f us/call' % (name, t / n * 1e6))
+
+# 原来findAll每次调用都要做的SQL拼接
+def findall_sql_before(cls, where=None, args=None, **kw):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderBy = kw.get('orderBy', None)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?, ?')
+            args.extend(limit)
+    return ' '.join(sql).replace('?', '%s'), args
+
+def bench_findall_sql():
+    report('findAll sql (rebuild)', timeit.timeit(lambda: findall_sql_before(Blog, orderBy='created_at desc', limit=(0, 10)), number=N))
+    report('findAll sql (cached)', timeit.timeit(lambda: Blog._findAllSql(None, 'created_at desc', 2), number=N))
+
+# 模拟aiohttp的Request，只提供RequestHandler用到的属性
+class FakeRequest(object):
+
+    def __init__(self, method='GET', query=None, match_info=None, body=None):
+        self.method = method
+        self.query = query or {}
+        self.query_string = '&'.join('%s=%s' % (k, v) for k, v in self.query.items())
+        self.match_info = match_info or {}
+        self.content_type = 'application/json' if method == 'POST' else ''
+        self.__user__ = None
+        self._body = body or {}
+
+    async def json(self):
+        return self._body
+
+# 不经过事件循环直接驱动协程，RequestHandler中没有真正的挂起点
+def run(coro):
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('coroutine suspended')
+
+async def noop(**kw):
+    return kw
+
+# handlers.py中各个处理函数的参数绑定开销，处理函数本身替换成noop，不访问数据库
+def bench_dispatch():
+    import handlers
+    from coroweb import RequestHandler
+    cases = [
+        (handlers.index, FakeRequest(query=dict(page='2'))),
+        (handlers.get_blog, FakeRequest(match_info=dict(id='0015000000000'))),
+        (handlers.api_blogs, FakeRequest(query=dict(page='3'))),
+        (handlers.api_update_blog, FakeRequest('POST', match_info=dict(id='0015000000000'), body=dict(name='n', summary='s', content='c'))),
+        (handlers.api_create_comment, FakeRequest('POST', match_info=dict(id='0015000000000'), body=dict(content='c'))),
+    ]
+    for fn, request in cases:
+        h = RequestHandler(None, fn)
+        h._func = noop
+        report('dispatch %s' % fn.__name__, timeit.timeit(lambda: run(h(request)), number=N))
+
+# api_blogs和api_comments返回值的序列化
+def bench_json():
+    import json, time, encoder
+    from apis import Page
+    from models import Comment
+    blogs = [Blog(id='%015d%s000' % (i, 'a' * 32), user_id='u1', user_name='Test', user_image='about:blank', name='blog %s' % i, summary='摘要' * 20, content='正文' * 500, html_content='<p>%s</p>' % ('正文' * 500), created_at=time.time()) for i in range(10)]
+    comments = [Comment(id='%015d%s000' % (i, 'b' * 32), blog_id='b1', user_id='u1', user_name='Test', user_image='about:blank', content='评论' * 50, created_at=time.time()) for i in range(10)]
+    payloads = [('api_blogs', dict(page=Page(100, 2), blogs=blogs)), ('api_comments', dict(page=Page(100, 2), comments=comments))]
+    n = N // 100
+    for name, r in payloads:
+        report('json %s (json.dumps)' % name, timeit.timeit(lambda: json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'), number=n), n)
+        report('json %s (encoder.dumps, %s)' % (name, encoder.backend), timeit.timeit(lambda: encoder.dumps(r), number=n), n)
+
+# 静态文件每秒请求数：同一个进程内启动只有/static/的app，分别用aiohttp的add_static和预读入内存的StaticHandler，
+# 并发concurrency个连接请求同一个文件(带Accept-Encoding和If-None-Match的请求各一半)
+def bench_static(name='js/vue.min.js', requests=5000, concurrency=20, port=8765):
+    import asyncio, time
+    import aiohttp
+    from aiohttp import web
+    from coroweb import add_static
+
+    async def hammer(memory):
+        app = web.Application()
+        add_static(app, memory=memory)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        url = 'http://127.0.0.1:%s/static/%s' % (port, name)
+        try:
+            async with aiohttp.ClientSession(auto_decompress=False) as session:
+                async with session.get(url) as resp:
+                    etag = resp.headers.get('ETag')
+                async def worker(k):
+                    for i in range(k, requests, concurrency):
+                        headers = {'Accept-Encoding': 'gzip'}
+                        if etag and i % 2:
+                            headers['If-None-Match'] = etag
+                        async with session.get(url, headers=headers) as resp:
+                            await resp.read()
+                start = time.time()
+                await asyncio.gather(*[worker(k) for k in range(concurrency)])
+                return time.time() - start
+        finally:
+            await runner.cleanup()
+
+    loop = asyncio.get_event_loop()
+    for memory in (False, True):
+        t = loop.run_until_complete(hammer(memory))
+        print('%-40s %8.0f req/s' % ('static %s (memory: %s)' % (name, memory), requests / t))
+
+if __name__ == '__main__':
+    bench_findall_sql()
+    bench_dispatch()
+    bench_json()
+    bench_static()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+进程内缓存
+
+LRUCache是一个有容量上限的缓存，超出容量时淘汰最久未使用的条目，
+并记录命中、未命中、淘汰次数，方便根据实际命中率调整容量。
+ttl不为None时，条目在写入ttl秒之后过期，过期的条目在下次读取时删除(计为未命中)。
+
+backend参数可以接入一个外部存储(例如memcached/redis的简单封装)，只需实现get(key)、set(key, value)、delete(key)三个方法：
+本地未命中时会去backend查找，写入和删除时同步到backend。
+'''
+
+import logging, threading, time
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    Bounded LRU cache with hit/miss/eviction counters.
+    '''
+    def __init__(self, maxsize=128, ttl=None, backend=None):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive: %s' % maxsize)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key => (value, 过期时间)，过期时间为None表示不过期
+        self._data = OrderedDict()
+        # 渲染可能发生在线程池中，所以要加锁
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return value
+                del self._data[key]
+                self.expirations = self.expirations + 1
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                with self._lock:
+                    self.hits = self.hits + 1
+                self._put(key, value)
+                return value
+        with self._lock:
+            self.misses = self.misses + 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self._put(key, value, ttl)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _put(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                k, v = self._data.popitem(last=False)
+                self.evictions = self.evictions + 1
+                logging.debug('cache evict: %s' % k)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations, hit_rate=(self.hits / total if total else 0.0))
+
+    def __str__(self):
+        return 'LRUCache(size: %(size)s, maxsize: %(maxsize)s, hits: %(hits)s, misses: %(misses)s, evictions: %(evictions)s)' % self.stats()
+
+    __repr__ = __str__
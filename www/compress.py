@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+响应压缩
+
+日志页(渲染好的Markdown)和管理页用到的JSON列表都很大，而且压缩率很高。compress_factory(见app.py)
+按Accept-Encoding选择压缩算法：装了brotli、zstandard时优先使用，gzip总是可用。
+
+1. 小于min_size的body不压缩，压缩后也省不了几个字节，反而多花CPU；
+2. 只压缩types中列出的Content-Type，图片、字体等本身已经压缩过；
+3. 超过executor_threshold的body交给线程池压缩(zlib、brotli、zstd压缩时都会释放GIL)，不卡住事件循环；
+4. 压缩后的body和原body字节不同，ETag改为弱校验W/"..."，同时设置Vary: Accept-Encoding，
+   coroweb.etag_matches比较时忽略W/，客户端带着弱ETag来时仍然可以返回304。
+'''
+
+import asyncio, gzip, logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from config import configs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_COMPRESS_CONFIG = configs.get('compress', {})
+
+# 默认压缩等级，gzip: 1~9，br: 0~11，zstd: 1~22
+_DEFAULT_LEVELS = dict(gzip=6, br=5, zstd=3)
+
+def _gzip(data, level):
+    # mtime=0，同样的body压缩结果相同
+    return gzip.compress(data, level, mtime=0)
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+# 编码 => 压缩函数，只包含已安装的
+_codecs = dict(gzip=_gzip)
+if brotli is not None:
+    _codecs['br'] = _brotli
+if zstandard is not None:
+    _codecs['zstd'] = _zstd
+
+def available():
+    return list(_codecs.keys())
+
+def level(encoding):
+    return _COMPRESS_CONFIG.get('levels', {}).get(encoding, _DEFAULT_LEVELS[encoding])
+
+# 解析Accept-Encoding，返回(客户端接受(q>0)的编码集合, 明确拒绝(q=0)的编码集合)
+def _accepted(accept_encoding):
+    accepted = set()
+    refused = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name)
+        else:
+            refused.add(name)
+    return accepted, refused
+
+# 按服务端的优先顺序(configs.compress.encodings)选择一个客户端接受的编码，没有时返回None；
+# 明确写了q=0的编码即使有*也不使用。candidates给出时只在其中选择(比如静态文件实际存在的预压缩版本)
+def choose_encoding(accept_encoding, candidates=None):
+    if not accept_encoding:
+        return None
+    accepted, refused = _accepted(accept_encoding)
+    for encoding in candidates or _COMPRESS_CONFIG.get('encodings', ('br', 'zstd', 'gzip')):
+        if encoding in refused or (candidates is None and encoding not in _codecs):
+            continue
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+# Content-Type是否需要压缩，例如'text/html'、'application/json'
+def compressible(content_type, size):
+    if size < _COMPRESS_CONFIG.get('min_size', 1024):
+        return False
+    return content_type in _COMPRESS_CONFIG.get('types', ('text/html', 'application/json'))
+
+def compress(data, encoding):
+    return _codecs[encoding](data, level(encoding))
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        size = _COMPRESS_CONFIG.get('executor_size', 2)
+        logging.info('create compress thread executor, size: %s' % size)
+        _executor = ThreadPoolExecutor(size)
+    return _executor
+
+# 大的body在线程池中压缩
+async def compress_async(data, encoding):
+    if len(data) < _COMPRESS_CONFIG.get('executor_threshold', 65536):
+        return compress(data, encoding)
+    return await asyncio.get_event_loop().run_in_executor(get_executor(), compress, data, encoding)
+
+# 响应的内容随Accept-Encoding不同，给Vary加上Accept-Encoding
+def add_vary(headers):
+    vary = headers.get('Vary')
+    if vary is None:
+        headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        headers['Vary'] = vary + ', Accept-Encoding'
+
+# 压缩后的响应使用弱ETag
+def weak_etag(etag):
+    return etag if etag.startswith('W/') else 'W/' + etag
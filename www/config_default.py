@@ -13,9 +13,81 @@ configs = {
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 连接池大小
+        'maxsize': 10,
+        'minsize': 1,
+        # 连接使用超过这么多秒后重建，-1表示不回收，应小于MySQL的wait_timeout
+        'pool_recycle': 3600,
+        # 等待空闲连接的最长时间(秒)，None表示一直等
+        'acquire_timeout': 5,
+        # 空闲超过pre_ping_idle秒的连接，使用前先ping一下
+        'pre_ping': True,
+        'pre_ping_idle': 30,
+        # 只读从库，每一项只需写出和主库不同的参数，例如 {'host': '10.0.0.2'}
+        'replicas': [],
+        # 从库选择方式：round_robin或least_in_flight
+        'balance': 'round_robin',
+        # 写操作之后，同一个浏览器在这么多秒内的读都走主库，避免从库延迟导致看不到自己刚写的数据
+        'sticky_seconds': 5,
+        # 批量写入时每条SQL处理的行数
+        'batch_size': 500,
+        # 列表页count的缓存时间(秒)
+        'count_ttl': 60,
+        # 为True时，不带条件的count直接读information_schema里的估算行数
+        'approximate_count': False,
+        # 不为空时把select的SQL形状(连同第一次的参数)记录到这个文件，再用python index_advisor.py检查索引
+        'query_shapes_file': ''
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        # 登录用户缓存的条目数和有效期(秒)
+        'user_cache_size': 1024,
+        'user_cache_ttl': 300
+    },
+    'api': {
+        # 流式导出(stream=1)时每页最多的条数
+        'stream_max_page_size': 10000,
+        # 同时进行的流式导出数，超出时返回stream:busy
+        'stream_max_concurrency': 2
+    },
+    'cache': {
+        # 匿名用户整页缓存和模板片段缓存的条目数、默认有效期(秒)
+        'page_size': 1024,
+        'page_ttl': 60,
+        'fragment_size': 1024,
+        'fragment_ttl': 300
+    },
+    'compress': {
+        # 响应压缩，encodings按优先顺序排列，br、zstd需要安装brotli、zstandard，没有安装时跳过
+        'enabled': True,
+        'encodings': ['br', 'zstd', 'gzip'],
+        'levels': {'gzip': 6, 'br': 5, 'zstd': 3},
+        # 小于min_size字节的body不压缩，超过executor_threshold字节的body在线程池中压缩
+        'min_size': 1024,
+        'executor_threshold': 65536,
+        'executor_size': 2,
+        'types': ['text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript', 'image/svg+xml']
+    },
+    'static': {
+        # 从assets.py的构建目录发送带hash文件名、预压缩的静态文件，build_dir为空时使用www/.static_build
+        'fingerprint': False,
+        'build_dir': '',
+        # 启动时把不超过memory_max_size字节的静态文件读进内存，更大的文件用sendfile发送
+        'memory': False,
+        'memory_max_size': 262144
+    },
+    'templates': {
+        # 生产模式：预编译全部模板，关闭auto_reload，编译结果保存在bytecode_cache_dir(为空时使用www/.templates_cache)
+        'production': False,
+        'bytecode_cache_dir': ''
+    },
+    'markdown': {
+        # 渲染结果缓存的最大条目数
+        'cache_size': 256,
+        # 超过这个长度(字符数)的正文交给executor渲染，executor可以是'thread'或'process'
+        'inline_threshold': 16384,
+        'executor': 'thread',
+        'executor_size': 4
     }
 }
\ No newline at end of file
@@ -2,16 +2,27 @@
 
 __author__ = 'Song-Xiangming'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, hashlib, mimetypes
 
-from urllib import parse
 from aiohttp import web
 
 from apis import APIError
 
-def get(path):
+import assets, compress
+
+# 路由的访问级别，auth_factory根据它决定要不要解析登录用户：
+# public: 不需要登录用户，不解析cookie
+# user: 解析登录用户(可能为None)，绑定到request.__user__
+# admin: 必须是管理员，否则跳转到登录页
+AUTH_PUBLIC = 'public'
+AUTH_USER = 'user'
+AUTH_ADMIN = 'admin'
+
+def get(path, auth=None, cache=None, tags=()):
     '''
     Define decorator @get('/path')
+
+    cache: cache the page for anonymous users for `cache` seconds, invalidated by tags. see pagecache.py
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -19,10 +30,12 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__auth__ = auth
+        wrapper.__cache__ = (cache, tuple(tags)) if cache else None
         return wrapper
     return decorator
 
-def post(path):
+def post(path, auth=None):
     '''
     Define decorator @post('/path')
     '''
@@ -32,9 +45,32 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__auth__ = auth
         return wrapper
     return decorator
 
+# 没有在@get/@post中指定auth时，按规则推断：/manage/下的页面需要管理员，
+# 有request参数的处理函数可能会用到request.__user__，其余的不需要登录用户
+def get_auth_level(fn):
+    auth = getattr(fn, '__auth__', None)
+    if auth is not None:
+        if auth not in (AUTH_PUBLIC, AUTH_USER, AUTH_ADMIN):
+            raise ValueError('Invalid auth level %s in %s.' % (auth, fn.__name__))
+        return auth
+    if getattr(fn, '__route__', '').startswith('/manage/'):
+        return AUTH_ADMIN
+    if has_request_arg(fn):
+        return AUTH_USER
+    return AUTH_PUBLIC
+
+# 取出当前请求匹配到的路由的整页缓存设置(ttl, tags)，没有设置时返回None
+def request_page_cache(request):
+    return getattr(request.match_info.handler, '__cache__', None)
+
+# 取出当前请求匹配到的路由的访问级别，静态文件和404等不是由add_route注册的路由返回None
+def request_auth_level(request):
+    return getattr(request.match_info.handler, '__auth__', None)
+
 '''
 廖大的意思是想把URL参数和GET、POST方法得到的参数彻底分离。
 
@@ -43,10 +79,15 @@ def post(path):
 3. REQUEST参数要位于最后一个POSITIONAL_OR_KEYWORD之后的任何地方
 '''	
 	
+# 注册路由时下面几个函数都要分析同一个fn的签名，缓存起来只做一次
+@functools.lru_cache(maxsize=None)
+def _signature(fn):
+    return inspect.signature(fn)
+
 # 获取所有没有默认值的关键字参数
 def get_required_kw_args(fn):
     args = []
-    params = inspect.signature(fn).parameters
+    params = _signature(fn).parameters
     #inspect模块从函数fn中获取参数信息，name:变量名，param.kind:变量类型
     for name, param in params.items():
         if param.kind == inspect.Parameter.KEYWORD_ONLY and param.default == inspect.Parameter.empty:
@@ -56,7 +97,7 @@ def get_required_kw_args(fn):
 # 获取所有关键字参数
 def get_named_kw_args(fn):
     args = []
-    params = inspect.signature(fn).parameters
+    params = _signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.KEYWORD_ONLY:
             args.append(name)
@@ -64,21 +105,21 @@ def get_named_kw_args(fn):
 	
 # 是否存在关键字参数
 def has_named_kw_args(fn):
-    params = inspect.signature(fn).parameters
+    params = _signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.KEYWORD_ONLY:
             return True
 			
 # 是否有变长字典参数
 def has_var_kw_arg(fn):
-    params = inspect.signature(fn).parameters
+    params = _signature(fn).parameters
     for name, param in params.items():
         if param.kind == inspect.Parameter.VAR_KEYWORD:
             return True
 			
 # 是否有request参数	
 def has_request_arg(fn):
-    sig = inspect.signature(fn)
+    sig = _signature(fn)
     params = sig.parameters
     found = False
     for name, param in params.items():
@@ -102,76 +143,228 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)       # 是否存在关键字参数
         self._named_kw_args = get_named_kw_args(fn)           # 所有关键字参数
         self._required_kw_args = get_required_kw_args(fn)     # 所有没有默认值的关键字参数
+        self.__auth__ = get_auth_level(fn)                    # 访问级别，供auth_factory使用
+        self.__cache__ = getattr(fn, '__cache__', None)       # 整页缓存设置，供page_cache_factory使用
+        # 绑定方案，注册时算好，每个请求只按它取参数：
+        # _wants_params: 是否需要从GET/POST中取参数(required_kw_args是named_kw_args的子集，不用单独判断)
+        # _select_kw_args: 只取这些名字的参数；有变长字典参数时为None，表示全部保留
+        self._wants_params = bool(self._has_var_kw_arg or self._has_named_kw_args)
+        self._select_kw_args = None if self._has_var_kw_arg else self._named_kw_args
+
+    # 从GET/POST参数中按绑定方案取出kw
+    def _bind(self, params):
+        if self._select_kw_args is None:
+            return dict(params)
+        return {name: params[name] for name in self._select_kw_args if name in params}
 
     #request是aiohttp中的request，注意观察后面怎么传入的
     async def __call__(self, request):
         kw = None
-        # required_kw_args是named_kw_args的真子集，第三个条件多余
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+        if self._wants_params:
             if request.method == 'POST':
                 if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
+                    return web.HTTPBadRequest(text='Missing Content-Type.')
                 ct = request.content_type.lower()
                 if ct.startswith('application/json'):
                     #request.json()可能是返回请求中json
                     params = await request.json()
                     if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
+                        return web.HTTPBadRequest(text='JSON body must be object.')
+                    kw = self._bind(params)
                 # 见笔记：http-关于application/x-www-form-urlencoded等字符编码的解释说明
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     params = await request.post()
-                    kw = dict(**params)
+                    kw = self._bind(params)
                 else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-                        
+                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+            elif request.method == 'GET':
+                if request.query_string:
+                    # request.query同一个参数出现多次时取第一个，和原来parse_qs(qs, True)取v[0]一致
+                    kw = self._bind(request.query)
+
         # 如果没有在GET或POST取得参数，直接把match_info的所有参数提取到kw
+        match_info = request.match_info
         if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            # 如果没有变长字典参数且有关键字参数，把所有关键字参数提取出来，忽略所有变长字典参数
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
+            kw = dict(match_info)
+        elif match_info:
             # 把match_info的参数提取到kw，检查URL参数和HTTP方法得到的参数是否有重合
-            # check named arg:
-            for k, v in request.match_info.items():
+            for k, v in match_info.items():
                 if k in kw:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kw[k] = v
-                
+
         # 把request参数提取到kw
         if self._has_request_arg:
             kw['request'] = request
-            
+
         # 检查没有默认值的关键字参数是否已赋值
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        for name in self._required_kw_args:
+            if not name in kw:
+                return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        # 只在debug级别才格式化参数
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('call with args: %s' % str(kw))
         try:
             r = await self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 	
+# 条件GET：根据body计算ETag，对比请求头If-None-Match/If-Modified-Since判断客户端缓存是否仍然有效
+def compute_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    # 比较时忽略弱校验前缀W/
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def is_not_modified(request, etag=None, last_modified=None):
+    # 两个请求头都有时以If-None-Match为准
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag is not None and etag_matches(if_none_match, etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return int(last_modified.timestamp()) <= int(request.if_modified_since.timestamp())
+    return False
+
+# 解析Range请求头，只支持单个范围，返回(start, end)(包含end)；
+# 无法解析或者不合法(比如end < start)时返回None，按RFC 7233忽略Range，发送完整文件；
+# 合法但start超出文件大小时返回False，对应416
+def parse_range(header, size):
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if start == '':
+            # bytes=-500 表示最后500字节
+            n = int(end)
+            if n <= 0:
+                return False
+            return (max(size - n, 0), size - 1)
+        start = int(start)
+        end = int(end) if end else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return False
+    return (start, size - 1 if end is None else min(end, size - 1))
+
+# 发送静态文件：
+# 1. 有预先压缩的.br/.gz时按Accept-Encoding发送压缩版本(带Range的请求总是发送原文件)；
+# 2. memory=True时，启动时把不超过memory_max_size的文件(包括压缩版本)读进内存，同时算好ETag，
+#    请求时直接从内存发送，支持If-None-Match和Range；更大的文件用FileResponse，由aiohttp通过sendfile零拷贝发送；
+# 3. 带hash的文件名(见assets.py)设置为永久缓存。
+class StaticHandler(object):
+
+    def __init__(self, root, memory=False, memory_max_size=262144):
+        self._root = os.path.realpath(root)
+        # 相对路径 => (内容, ETag, Content-Type)
+        self._files = dict()
+        if memory:
+            self._preload(memory_max_size)
+
+    def _preload(self, max_size):
+        total = 0
+        for dirpath, dirs, files in os.walk(self._root):
+            for fn in files:
+                path = os.path.join(dirpath, fn)
+                if os.path.getsize(path) > max_size:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                name = os.path.relpath(path, self._root).replace(os.sep, '/')
+                self._files[name] = (data, compute_etag(data), self._content_type(name))
+                total = total + len(data)
+                # 没有构建过(fingerprint=False)时static/下没有.gz/.br，在内存里压缩一份，请求时不用再压缩
+                for ext, compressed in assets.variants(name, data).items():
+                    if name + ext not in self._files:
+                        self._files[name + ext] = (compressed, compute_etag(compressed), self._content_type(name))
+                        total = total + len(compressed)
+        logging.info('preload %s static files (%s bytes) into memory.' % (len(self._files), total))
+
+    def _content_type(self, name):
+        # 压缩版本的Content-Type和原文件一样
+        for ext in ('.br', '.gz'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        ct, _ = mimetypes.guess_type(name)
+        return ct or 'application/octet-stream'
+
+    def _exists(self, name, path):
+        return name in self._files or os.path.isfile(path)
+
+    async def __call__(self, request):
+        name = request.match_info['filename']
+        path = os.path.realpath(os.path.join(self._root, name))
+        if not path.startswith(self._root + os.sep):
+            raise web.HTTPNotFound()
+        name = path[len(self._root) + 1:].replace(os.sep, '/')
+        if not self._exists(name, path):
+            raise web.HTTPNotFound()
+        headers = dict(Vary='Accept-Encoding')
+        if assets.is_fingerprinted(name):
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'public, max-age=3600'
+        range_header = request.headers.get('Range')
+        if range_header is None:
+            # 只在这个文件实际存在的压缩版本中选择，q=0的编码不会选中
+            exts = dict(br='.br', gzip='.gz')
+            candidates = [enc for enc in ('br', 'gzip') if self._exists(name + exts[enc], path + exts[enc])]
+            enc = compress.choose_encoding(request.headers.get('Accept-Encoding'), candidates) if candidates else None
+            if enc is not None:
+                headers['Content-Encoding'] = enc
+                name = name + exts[enc]
+                path = path + exts[enc]
+        item = self._files.get(name)
+        if item is None:
+            resp = web.FileResponse(path, headers=headers)
+            resp.content_type = self._content_type(name)
+            return resp
+        data, etag, ct = item
+        headers['ETag'] = etag
+        headers['Accept-Ranges'] = 'bytes'
+        if is_not_modified(request, etag):
+            return web.Response(status=304, headers=headers)
+        if range_header is not None:
+            r = parse_range(range_header, len(data))
+            if r is False:
+                headers['Content-Range'] = 'bytes */%s' % len(data)
+                return web.Response(status=416, headers=headers)
+            if r is not None:
+                start, end = r
+                headers['Content-Range'] = 'bytes %s-%s/%s' % (start, end, len(data))
+                return web.Response(status=206, body=data[start:end + 1], headers=headers, content_type=ct)
+        return web.Response(body=data, headers=headers, content_type=ct)
+
 # handle static files (images, JavaScripts, CSS files etc.
 # 见aiohttp官方文档中Static file handling，搜add_static
-def add_static(app):
+# fingerprint=True时，先用assets.py构建(或加载已构建的)静态文件，从构建目录发送
+# memory=True时，小文件预先读入内存发送，见StaticHandler
+def add_static(app, fingerprint=False, build_dir=None, memory=False, memory_max_size=262144):
     # 获取当前脚本文件路径: os.path.dirname(os.path.abspath(__file__)) 
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    if fingerprint:
+        build_dir = build_dir or assets.BUILD_DIR
+        assets.init(build_dir, path)
+        path = build_dir
+    if fingerprint or memory:
+        app.router.add_route('GET', '/static/{filename:.+}', StaticHandler(path, memory, memory_max_size))
+        logging.info('add static %s => %s (fingerprint: %s, memory: %s)' % ('/static/', path, fingerprint, memory))
+        return
     app.router.add_static('/static/', path)
     logging.info('add static %s => %s' % ('/static/', path))
 
@@ -183,7 +376,7 @@ def add_route(app, fn):
         raise ValueError('@get or @post not defined in %s.' % str(fn))
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
-    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    logging.info('add route %s %s => %s(%s) [%s]' % (method, path, fn.__name__, ', '.join(_signature(fn).parameters.keys()), get_auth_level(fn)))
     app.router.add_route(method, path, RequestHandler(app, fn))	
 	
 '''
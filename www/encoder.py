@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+JSON序列化
+
+原来response_factory每次都调用json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__)，
+json.dumps带参数时每次都会新建一个JSONEncoder，Page等对象还要走default。这里：
+
+1. 装了orjson就用orjson，其次是ujson(需要支持default参数的版本)，都没有时用标准库，并复用同一个JSONEncoder；
+2. orm.Model本身是dict，可以直接序列化；Page、CursorPage等对象按类型查表转换，其他对象仍然回退到__dict__；
+3. iter_dumps()把结果分块输出，配合web.StreamResponse发送大列表，不用先拼出完整的body。
+'''
+
+import json, logging
+
+from apis import Page, CursorPage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+    # 老版本的ujson不支持default参数
+    ujson.dumps({}, default=str)
+except (ImportError, TypeError):
+    ujson = None
+
+# 类型 => 转换函数，把对象转换成可以直接序列化的dict/list
+_encoders = dict()
+
+def register(cls, fn):
+    _encoders[cls] = fn
+
+register(Page, lambda p: p.__dict__)
+register(CursorPage, lambda p: p.__dict__)
+
+def _default(o):
+    fn = _encoders.get(type(o))
+    if fn is not None:
+        return fn(o)
+    return o.__dict__
+
+_encoder = json.JSONEncoder(ensure_ascii=False, default=_default)
+
+if orjson is not None:
+    backend = 'orjson'
+elif ujson is not None:
+    backend = 'ujson'
+else:
+    backend = 'json'
+logging.info('json backend: %s' % backend)
+
+# obj->utf-8编码的bytes
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')
+    return _encoder.encode(obj).encode('utf-8')
+
+# 分块输出，每块大约chunk_size字节
+def iter_dumps(obj, chunk_size=16384):
+    if orjson is not None or ujson is not None:
+        # 第三方库没有增量接口，但dict/list可以逐个元素编码
+        if isinstance(obj, dict):
+            yield b'{'
+            first = True
+            for k, v in obj.items():
+                yield (b'' if first else b',') + dumps(str(k)) + b':'
+                first = False
+                for chunk in iter_dumps(v, chunk_size):
+                    yield chunk
+            yield b'}'
+        elif isinstance(obj, (list, tuple)):
+            buf = [b'[']
+            size = 1
+            for i, v in enumerate(obj):
+                s = dumps(v)
+                buf.append(b',' + s if i else s)
+                size = size + len(s) + 1
+                if size >= chunk_size:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+            buf.append(b']')
+            yield b''.join(buf)
+        else:
+            yield dumps(obj)
+        return
+    buf = []
+    size = 0
+    for s in _encoder.iterencode(obj):
+        buf.append(s)
+        size = size + len(s)
+        if size >= chunk_size:
+            yield ''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf).encode('utf-8')
+
+class JsonStream(object):
+    '''
+    JSON object response whose list under key is produced by an async iterator.
+    '''
+    # head: 其余的字段(比如page)，key: 列表字段名，rows: async迭代器
+    # 返回给response_factory后，会用chunked编码的web.StreamResponse边读边发送
+    def __init__(self, head, key, rows, chunk_size=16384):
+        self.head = head
+        self.key = key
+        self.rows = rows
+        self.chunk_size = chunk_size
+
+    # 没有发送(比如prepare时客户端已经断开)也要调用，让ORM归还连接
+    async def aclose(self):
+        if hasattr(self.rows, 'aclose'):
+            await self.rows.aclose()
+
+    async def chunks(self):
+        head = dumps(self.head)
+        # {"page":...} => {"page":...,"key":[
+        prefix = b'{' if head == b'{}' else head[:-1] + b','
+        buf = [prefix + dumps(self.key) + b':[']
+        size = len(buf[0])
+        n = 0
+        try:
+            async for row in self.rows:
+                s = dumps(row)
+                buf.append(b',' + s if n else s)
+                n = n + 1
+                size = size + len(s) + 1
+                if size >= self.chunk_size:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+        finally:
+            # 客户端中途断开时也要结束迭代，让ORM归还连接
+            await self.aclose()
+        buf.append(b']}')
+        yield b''.join(buf)
+        logging.info('json stream sent: %s rows' % n)
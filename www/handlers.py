@@ -6,12 +6,12 @@ __author__ = 'Song-Xiangming'
 
 import re, time, json, logging, hashlib, base64, asyncio
 
-import markdown2
+import orm, renderer, encoder, pagecache
 
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIError, APIValueError, APIResourceNotFoundError
+from apis import Page, CursorPage, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 
 from models import User, Comment, Blog, next_id
 from config import configs
@@ -52,7 +52,7 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = await User.find(uid)
+        user = await User.findCached(uid)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -81,6 +81,83 @@ def get_page_index(page_str):
         p = 1
     return p
     
+# 日志列表不需要渲染好的html_content，只有get_blog/api_get_blog需要，列表页少取一个mediumtext列
+_BLOG_LIST_COLUMNS = tuple(f for f in Blog.__fields__ if f != 'html_content')
+
+# 游标分页查询，按created_at倒序，不需要count也不需要跳过前面的行
+async def find_cursor_page(model, cursor, columns=None):
+    p = CursorPage(cursor)
+    items = await model.findAll(keyset='created_at', desc=True, after=p.after, limit=p.limit, columns=columns)
+    return p, p.paginate(items)
+
+# 流式导出时每页最多的条数
+_STREAM_MAX_PAGE_SIZE = configs.get('api', {}).get('stream_max_page_size', 10000)
+
+# 获取导出的每页条数
+def get_page_size(size_str):
+    s = 10
+    try:
+        s = int(size_str)
+    except ValueError as e:
+        pass
+    return min(max(s, 1), _STREAM_MAX_PAGE_SIZE)
+
+# 同时进行的流式导出数，每个导出在客户端读完之前都占着一个数据库连接
+_STREAM_MAX_CONCURRENCY = configs.get('api', {}).get('stream_max_concurrency', 2)
+_active_streams = 0
+
+# 流式返回一页数据：JSON在读数据库的同时分块发送，适合一页上万条的导出，只有管理员可以使用
+# 检查和计数之间没有await，并发的导出请求不会都通过检查；计数在JsonStream关闭时减掉
+async def stream_page(request, model, key, page, size, mapper=None):
+    global _active_streams
+    check_admin(request)
+    if _active_streams >= _STREAM_MAX_CONCURRENCY:
+        raise APIError('stream:busy', key, 'Too many exports in progress, please retry later.')
+    _active_streams = _active_streams + 1
+    try:
+        num = await model.findNumber('count(id)', cache=True)
+    except BaseException:
+        _active_streams = _active_streams - 1
+        raise
+    p = Page(num, get_page_index(page), get_page_size(size))
+    rows = model.findStream(orderBy='created_at desc', limit=(p.offset, p.limit))
+    if mapper is not None:
+        rows = _map_rows(rows, mapper)
+    return encoder.JsonStream(dict(page=p), key, _CountedRows(rows))
+
+class _CountedRows(object):
+    '''
+    Async iterator that releases one stream slot when closed, whether or not it was iterated.
+    '''
+    def __init__(self, rows):
+        self._rows = rows
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._rows.__anext__()
+
+    async def aclose(self):
+        global _active_streams
+        if self._closed:
+            return
+        self._closed = True
+        _active_streams = _active_streams - 1
+        await self._rows.aclose()
+
+async def _map_rows(rows, mapper):
+    try:
+        async for r in rows:
+            yield mapper(r)
+    finally:
+        await rows.aclose()
+
+def _hide_passwd(u):
+    u.passwd = '******'
+    return u
+
 # text->html
 def text2html(text):
     # filter去掉空行，map转义&,<,>符号，并加上p标签
@@ -92,15 +169,15 @@ def text2html(text):
 
 ''' ·············<首页部分>············· '''
 # 默认首页
-@get('/')
+@get('/', cache=60, tags=('blogs',))
 async def index(request, *, page='1'):
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.findNumber('count(id)', cache=True)
     page = Page(num)
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), columns=_BLOG_LIST_COLUMNS)
     return{
         '__template__': 'blogs.html',
         'page': page,
@@ -159,7 +236,7 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 # api：signin
@@ -185,14 +262,21 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
     
 # api: get users    
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(request, *, page='1', cursor=None, stream=None, size='10'):
+    if stream:
+        return await stream_page(request, User, 'users', page, size, _hide_passwd)
+    if cursor is not None:
+        p, users = await find_cursor_page(User, cursor)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
+    num = await User.findNumber('count(id)', cache=True)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
@@ -208,13 +292,15 @@ async def api_get_users(*, page='1'):
 ''' ·············<Blog相关>············· '''
 # 日志详情页
 # 获取对应id的blog，并绑定html版的博文和评论，markdown2见笔记
-@get('/blog/{id}')
+@get('/blog/{id}', cache=60, tags=('blog:{id}',))
 async def get_blog(request, *, id):
     blog = await Blog.find(id)
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    # html_content在保存时已经算好，只有还没回填的老数据才需要现场渲染
+    if not blog.html_content:
+        blog.html_content = await renderer.markdown_async(blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
@@ -281,13 +367,17 @@ async def api_get_blog(*, id):
     
 # api: get blogs by page
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    # 带cursor参数(可以为空串，表示第一页)时使用游标分页
+    if cursor is not None:
+        p, blogs = await find_cursor_page(Blog, cursor, _BLOG_LIST_COLUMNS)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.findNumber('count(id)', cache=True)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), columns=_BLOG_LIST_COLUMNS)
     return dict(page=p, blogs=blogs)    
     
 # api: create blog        
@@ -302,7 +392,9 @@ async def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    blog.html_content = await renderer.markdown_async(blog.content)
     await blog.save()
+    pagecache.invalidate('blogs')
     return blog
 
 # api: update blog    
@@ -316,10 +408,14 @@ async def api_update_blog(id, request, *, name, summary, content):
         raise APIValueError('summary', 'summary cannot be empty.')
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
+    # 正文变了，旧的渲染缓存就没用了
+    renderer.invalidate(blog.content)
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.html_content = await renderer.markdown_async(blog.content)
     await blog.update()
+    pagecache.invalidate('blogs', 'blog:%s' % blog.id)
     return blog
 
 # api: delete blog        
@@ -327,14 +423,26 @@ async def api_update_blog(id, request, *, name, summary, content):
 async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
-    await blog.remove()
+    renderer.invalidate(blog.content)
+    # 日志和它的评论一起删除
+    async with orm.transaction():
+        await blog.remove()
+        await orm.execute('delete from `comments` where `blog_id`=?', [id])
+    orm.invalidate_count('comments')
+    pagecache.invalidate('blogs', 'blog:%s' % id)
     return dict(id=id)
 
 # api: get comments
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(request, *, page='1', cursor=None, stream=None, size='10'):
+    # stream=1时流式返回，size指定每页条数，只有管理员可以使用
+    if stream:
+        return await stream_page(request, Comment, 'comments', page, size)
+    if cursor is not None:
+        p, comments = await find_cursor_page(Comment, cursor)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
+    num = await Comment.findNumber('count(id)', cache=True)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
@@ -354,6 +462,7 @@ async def api_create_comment(id, request, *, content):
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
     await comment.save()
+    pagecache.invalidate('blog:%s' % blog.id)
     return comment
 
 # api: delete comments
@@ -364,6 +473,7 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    pagecache.invalidate('blog:%s' % c.blog_id)
     return dict(id=id)
 
 
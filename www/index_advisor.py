@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+索引检查
+
+1. 在config_override.py的db中设置query_shapes_file(例如'/tmp/awesome_shapes.jsonl')，运行网站并访问各个页面，
+   orm.select()会把每种SQL形状连同第一次的参数记录下来；
+2. python index_advisor.py /tmp/awesome_shapes.jsonl
+   对每种形状执行EXPLAIN，标出全表扫描(type=ALL)、没有用到索引、需要filesort或临时表的查询；
+   同时对比models.py中声明的索引(Field的index参数和Model的__indexes__)和数据库中实际的索引，打印缺少的索引的DDL。
+
+python index_advisor.py --ddl 打印根据models.py生成的建表语句。
+'''
+
+import logging; logging.basicConfig(level=logging.WARNING)
+
+import sys, json, asyncio
+
+import orm
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = (User, Blog, Comment)
+
+def load_shapes(path):
+    shapes = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                shapes.append(json.loads(line))
+    return shapes
+
+# 返回EXPLAIN结果中值得注意的问题
+def problems(row):
+    L = []
+    if row.get('type') == 'ALL':
+        L.append('full table scan')
+    elif row.get('key') is None and row.get('table') is not None:
+        L.append('no index used')
+    extra = row.get('Extra') or ''
+    if 'Using filesort' in extra:
+        L.append('filesort')
+    if 'Using temporary' in extra:
+        L.append('temporary table')
+    return L
+
+async def explain(shapes):
+    flagged = 0
+    for shape in shapes:
+        rs = await orm.select_prepared('explain ' + shape['sql'], shape['args'])
+        issues = []
+        for r in rs:
+            issues.extend(problems(r))
+        if issues:
+            flagged = flagged + 1
+            print('[%s] %s' % (', '.join(issues), shape['sql']))
+            for r in rs:
+                print('    table: %s, type: %s, possible_keys: %s, key: %s, rows: %s, extra: %s' % (r.get('table'), r.get('type'), r.get('possible_keys'), r.get('key'), r.get('rows'), r.get('Extra')))
+        else:
+            print('[ok] %s' % shape['sql'])
+    print('%s of %s query shapes flagged.' % (flagged, len(shapes)))
+
+# models.py中声明了、数据库中还没有的索引
+async def missing_indexes():
+    missing = []
+    for model in MODELS:
+        rs = await orm.select('show index from `%s`' % model.__table__, [])
+        existing = set(r['Key_name'] for r in rs)
+        for (name, cols, unique), ddl in zip(model.__index_defs__, model.__create_indexes__):
+            if name not in existing:
+                missing.append(ddl)
+    if missing:
+        print('missing indexes:')
+        for ddl in missing:
+            print('    %s' % ddl)
+    else:
+        print('all declared indexes exist.')
+
+async def advise(loop, path):
+    # EXPLAIN本身不用再记录
+    await orm.create_pool(loop=loop, **dict(configs.db, query_shapes_file=''))
+    try:
+        await explain(load_shapes(path))
+        await missing_indexes()
+    finally:
+        await orm.destory_pool()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python index_advisor.py shapes_file | --ddl')
+        sys.exit(1)
+    if sys.argv[1] == '--ddl':
+        for model in MODELS:
+            print(model.__create_table__)
+            print()
+        sys.exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(advise(loop, sys.argv[1]))
+    loop.close()
@@ -0,0 +1,6 @@
+-- migrate_html_content.sql
+-- 给已有的blogs表加上html_content列，执行完后运行 python backfill.py 回填老数据
+
+use awesome;
+
+alter table blogs add column `html_content` mediumtext not null after `content`;
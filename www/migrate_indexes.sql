@@ -0,0 +1,9 @@
+-- migrate_indexes.sql
+-- 给已有的表补上models.py中声明的索引(schema.sql中已经包含)：
+-- get_blog按blog_id查评论并按created_at排序，作者信息同步(refresh_authors.py)按user_id查blogs和comments
+
+use awesome;
+
+alter table blogs add key `idx_user_id` (`user_id`);
+alter table comments add key `idx_user_id` (`user_id`);
+alter table comments add key `idx_blog_id_created_at` (`blog_id`, `created_at`);
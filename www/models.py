@@ -15,9 +15,13 @@ __author__= 'Song-Xiangming'
 显示的时候，只需要做一个float到str的转换，也非常容易。
 '''
 
-import time, uuid
+import asyncio, contextvars, logging, time, uuid
+
+import orm
 
 from orm import Model, StringField, BooleanField, FloatField, TextField
+from cache import LRUCache
+from config import configs
 
 #creates a random and unique UUID.
 def next_id():
@@ -27,32 +31,145 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id,ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', index='unique')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+    # 按id缓存用户，供cookie2user校验登录使用，避免每个请求都查一次数据库
+    # 通过update()/remove()修改用户(改密码、改admin)时自动失效
+    @classmethod
+    async def findCached(cls, pk):
+        ' find user by primary key through the session user cache. '
+        r = _user_cache.get(pk)
+        if r is None:
+            user = await cls.find(pk)
+            if user is None:
+                return None
+            r = dict(user)
+            _user_cache.set(pk, r)
+        # 每次返回新对象，调用方修改(比如把passwd改成******)不会影响缓存
+        return cls(**r)
+
+    # 写之前和写之后都要清缓存：只在写之前清的话，写完成之前进来的cookie2user会把旧的passwd、admin重新缓存user_cache_ttl秒
+    # 改名、换头像之后，blogs、comments里冗余的user_name、user_image在后台分批同步
+    async def update(self):
+        _user_cache.delete(self.id)
+        await super(User, self).update()
+        _user_cache.delete(self.id)
+        # 在事务中时等提交之后再同步，回滚的修改不会写进blogs、comments
+        orm.after_commit(lambda: schedule_author_refresh(self))
+
+    async def remove(self):
+        _user_cache.delete(self.id)
+        await super(User, self).remove()
+        _user_cache.delete(self.id)
+
+    @classmethod
+    async def update_many(cls, rows, batch_size=None):
+        rows = list(rows)
+        _evict_users(rows)
+        affected = await super(User, cls).update_many(rows, batch_size)
+        _evict_users(rows)
+        return affected
+
+    @classmethod
+    async def remove_many(cls, rows, batch_size=None):
+        rows = list(rows)
+        _evict_users(rows)
+        affected = await super(User, cls).remove_many(rows, batch_size)
+        _evict_users(rows)
+        return affected
+
+_user_cache = LRUCache(configs.session.get('user_cache_size', 1024), ttl=configs.session.get('user_cache_ttl', 300))
+
+def invalidate_user(uid):
+    _user_cache.delete(uid)
+
+def _evict_users(users):
+    for u in users:
+        _user_cache.delete(u.id)
+
+def user_cache_stats():
+    return _user_cache.stats()
+
+# Blog、Comment在写入时复制了作者的name和image(读的时候不用join users)，用户修改后调用这里同步，
+# 见orm.Model.refresh_columns。返回更新的行数：(blogs, comments)
+async def refresh_author(user, batch_size=None, pause=0.1):
+    # 从主库重新读取已提交的数据，不用调用方内存里的name、image
+    token, route = orm.begin_route(primary=True)
+    try:
+        user = await User.find(user.id)
+    finally:
+        orm.end_route(token)
+    if user is None:
+        return 0, 0
+    columns = dict(user_name=user.name, user_image=user.image)
+    blogs = await Blog.refresh_columns('user_id', user.id, columns, batch_size, pause)
+    comments = await Comment.refresh_columns('user_id', user.id, columns, batch_size, pause)
+    logging.info('author %s refreshed: %s blogs, %s comments' % (user.id, blogs, comments))
+    if (blogs or comments) and _author_refresh_hooks:
+        # 受影响的日志：作者的日志和作者评论过的日志
+        rs = await orm.select('select `id` from `blogs` where `user_id`=? union select `blog_id` from `comments` where `user_id`=?', [user.id, user.id])
+        blog_ids = [r['id'] for r in rs]
+        for fn in _author_refresh_hooks:
+            fn(blog_ids)
+    return blogs, comments
+
+# 作者信息同步完成后调用fn(blog_ids)，app.py用它让页面缓存失效；
+# models不直接依赖pagecache(jinja2)，backfill.py等命令行脚本不需要加载web层
+_author_refresh_hooks = []
+
+def on_author_refresh(fn):
+    _author_refresh_hooks.append(fn)
+
+# user_id => 正在执行的同步任务，同一个用户连续修改时，等当前任务结束后再用最新的数据跑一次
+_author_tasks = dict()
+_author_pending = dict()
+
+def schedule_author_refresh(user):
+    if user.id in _author_tasks:
+        _author_pending[user.id] = user
+        return
+    # 在空的context中创建任务，不继承调用方的orm.transaction()连接和请求的路由状态
+    task = contextvars.Context().run(asyncio.ensure_future, refresh_author(user))
+    _author_tasks[user.id] = task
+    task.add_done_callback(lambda t: _author_refresh_done(user.id, t))
+
+def _author_refresh_done(uid, task):
+    del _author_tasks[uid]
+    if not task.cancelled() and task.exception() is not None:
+        # 没有同步完的行，下次修改或运行refresh_authors.py时会补上
+        logging.error('author %s refresh failed: %s' % (uid, task.exception()))
+    user = _author_pending.pop(uid, None)
+    if user is not None:
+        schedule_author_refresh(user)
 
 class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    # content渲染后的html，保存/修改时计算一次，读的时候直接用
+    html_content = TextField(default='', ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    # get_blog按blog_id查评论并按created_at排序
+    __indexes__ = [('blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
\ No newline at end of file
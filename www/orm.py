@@ -21,19 +21,57 @@ __author__ = 'Song-Xiangming'
     通过Field类将user类的属性映射到User表的列中，其中每一列的字段又有自己的一些属性，包括数据类型，列名，主键和默认值
 '''
 
-import asyncio, logging
+import asyncio, contextvars, itertools, json, logging, time, weakref
 import aiomysql
 
+from contextlib import asynccontextmanager
+
+from cache import LRUCache
+
 #打印SQL查询语句
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
-	
-# 创建一个全局的连接池，每个HTTP请求都从池中获得数据库连接
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    # 全局变量__pool用于存储整个连接池
-    global __pool
-    __pool = await aiomysql.create_pool(
+
+# __pool是主库连接池，所有写操作都走主库；__replicas是只读从库的连接池列表
+__pool = None
+__replicas = []
+# 每个从库上正在执行的查询数，用于least_in_flight均衡
+_replica_in_flight = []
+_replica_counter = itertools.count()
+
+# 连接池的配置，在create_pool时从kw(即configs.db)中读取
+# acquire_timeout: 从池中获取连接的最长等待时间(秒)，超时直接报错，不让请求无限排队
+# pre_ping: 连接空闲超过pre_ping_idle秒后，使用前先ping一下，失效就换一个
+# balance: 从库的选择方式，round_robin(轮询)或least_in_flight(当前查询最少)
+# batch_size: save_many/update_many/remove_many每批处理的行数
+# count_ttl: findNumber(cache=True)结果的缓存时间(秒)；approximate_count: 无where的count用表统计信息估算
+# query_shapes_file: 不为空时，select()遇到新的SQL形状(占位符形式的SQL)就追加一行JSON到这个文件，供index_advisor.py执行EXPLAIN
+_pool_options = dict(acquire_timeout=None, pre_ping=True, pre_ping_idle=30, balance='round_robin', batch_size=500, count_ttl=60, approximate_count=False, query_shapes_file='')
+
+# 连接池统计：获取次数、等待时间、超时次数、ping次数
+_pool_stats = dict(acquires=0, total_wait=0.0, max_wait=0.0, timeouts=0, pings=0, ping_failures=0)
+
+# 记录每个连接的创建时间和最后一次归还的时间，连接被池关闭后自动消失
+_conn_created = weakref.WeakKeyDictionary()
+_conn_released = weakref.WeakKeyDictionary()
+
+# 当前事务占用的连接，见transaction()
+_transaction = contextvars.ContextVar('orm_transaction', default=None)
+# 当前事务提交后要执行的函数，见after_commit()
+_after_commit = contextvars.ContextVar('orm_after_commit', default=None)
+
+# 当前请求的路由状态：primary为True时读也走主库，wrote表示本次请求写过数据
+# 由app.py的middleware在每个请求开始时设置
+_route = contextvars.ContextVar('orm_route', default=None)
+
+class PoolTimeoutError(asyncio.TimeoutError):
+    '''
+    Raised when no connection can be acquired within acquire_timeout.
+    '''
+    pass
+
+async def _create_pool(loop, kw):
+    return await aiomysql.create_pool(
         # **kw参数可以包含所有连接需要用到的关键字参数
         # 默认本机IP
         host = kw.get('host','localhost'),
@@ -46,33 +84,237 @@ async def create_pool(loop, **kw):
         # 默认最大连接数为10
         maxsize = kw.get('maxsize',10),
         minsize = kw.get('minsize',1),
+        # 连接使用超过pool_recycle秒后由aiomysql关闭重建，-1表示不回收
+        pool_recycle = kw.get('pool_recycle',-1),
         # 接收一个event_loop实例
         loop = loop
-    ) 
+    )
+
+# 创建一个全局的连接池，每个HTTP请求都从池中获得数据库连接
+# kw['replicas']是从库列表，每一项是一个dict，只需写出和主库不同的参数(比如host)
+async def create_pool(loop, **kw):
+    logging.info('create database connection pool...')
+    # 全局变量__pool用于存储整个连接池
+    global __pool, __replicas, _replica_in_flight, _count_cache
+    for k in _pool_options.keys():
+        if k in kw:
+            _pool_options[k] = kw[k]
+    _count_cache = LRUCache(1024, ttl=_pool_options['count_ttl'])
+    __pool = await _create_pool(loop, kw)
+    replicas = []
+    for replica in kw.get('replicas') or []:
+        rkw = dict(kw)
+        rkw.update(replica)
+        logging.info('create replica connection pool: %s:%s' % (rkw.get('host','localhost'), rkw.get('port',3306)))
+        replicas.append(await _create_pool(loop, rkw))
+    __replicas = replicas
+    _replica_in_flight = [0] * len(replicas)
 
 
 async def destory_pool():
-    global __pool
-    if __pool is not None :
-        __pool.close()
-        await __pool.wait_closed()
-	
+    global __pool, __replicas
+    for pool in [__pool] + __replicas:
+        if pool is not None :
+            pool.close()
+            await pool.wait_closed()
+    __pool = None
+    __replicas = []
+
+def has_replicas():
+    return len(__replicas) > 0
+
+# 请求开始时调用，primary=True表示这个请求的读也要走主库，返回的token交给end_route()
+def begin_route(primary=False):
+    route = dict(primary=primary, wrote=False)
+    return _route.set(route), route
+
+def end_route(token):
+    _route.reset(token)
+
+# 当前请求之后的读都走主库
+def use_primary():
+    route = _route.get()
+    if route is not None:
+        route['primary'] = True
+
+# 写过数据之后，本次请求后面的读要走主库，才能读到自己刚写的数据
+def _mark_write():
+    route = _route.get()
+    if route is not None:
+        route['wrote'] = True
+        route['primary'] = True
+
+# 选一个从库，返回下标；没有从库或当前请求要求读主库时返回None
+def _pick_replica():
+    if not __replicas:
+        return None
+    route = _route.get()
+    if route is not None and route['primary']:
+        return None
+    if _pool_options['balance'] == 'least_in_flight':
+        return min(range(len(__replicas)), key=lambda i: _replica_in_flight[i])
+    return next(_replica_counter) % len(__replicas)
+
+# 从池中取一个连接，记录等待时间，必要时先ping
+async def _acquire(pool):
+    start = time.time()
+    timeout = _pool_options['acquire_timeout']
+    try:
+        if timeout:
+            conn = await asyncio.wait_for(pool.acquire(), timeout)
+        else:
+            conn = await pool.acquire()
+    except asyncio.TimeoutError:
+        _pool_stats['timeouts'] = _pool_stats['timeouts'] + 1
+        logging.warning('acquire connection timeout after %s seconds, pool size: %s, free: %s' % (timeout, pool.size, pool.freesize))
+        raise PoolTimeoutError('acquire connection timeout after %s seconds' % timeout)
+    now = time.time()
+    wait = now - start
+    _pool_stats['acquires'] = _pool_stats['acquires'] + 1
+    _pool_stats['total_wait'] = _pool_stats['total_wait'] + wait
+    _pool_stats['max_wait'] = max(_pool_stats['max_wait'], wait)
+    if conn not in _conn_created:
+        _conn_created[conn] = now
+    elif _pool_options['pre_ping'] and now - _conn_released.get(conn, now) > _pool_options['pre_ping_idle']:
+        _pool_stats['pings'] = _pool_stats['pings'] + 1
+        try:
+            await conn.ping(False)
+        except Exception as e:
+            # 连接已经失效(比如被MySQL的wait_timeout断开)，关掉它换一个新的
+            _pool_stats['ping_failures'] = _pool_stats['ping_failures'] + 1
+            logging.warning('stale connection dropped: %s' % e)
+            conn.close()
+            pool.release(conn)
+            return await _acquire(pool)
+    return conn
+
+def _release(pool, conn):
+    _conn_released[conn] = time.time()
+    pool.release(conn)
+
+# 用法：async with connection() as conn:
+# readonly=True时，如果配置了从库就从从库取连接；在transaction()中时直接使用事务的连接
+@asynccontextmanager
+async def connection(readonly=False):
+    conn = _transaction.get()
+    if conn is not None:
+        yield conn
+        return
+    i = _pick_replica() if readonly else None
+    if i is None:
+        pool = __pool
+    else:
+        pool = __replicas[i]
+        _replica_in_flight[i] = _replica_in_flight[i] + 1
+    try:
+        conn = await _acquire(pool)
+        try:
+            yield conn
+        finally:
+            _release(pool, conn)
+    finally:
+        if i is not None:
+            _replica_in_flight[i] = _replica_in_flight[i] - 1
+
+# 显式事务：
+#     async with orm.transaction():
+#         await blog.remove()
+#         await Comment.remove_many(comments)
+# 块内所有的Model操作和select/execute都使用同一个主库连接，正常结束时提交，抛出异常时回滚。
+# 嵌套的transaction()直接并入最外层的事务。块内不要用asyncio.gather等方式并发执行SQL，它们会共用这个连接。
+@asynccontextmanager
+async def transaction():
+    conn = _transaction.get()
+    if conn is not None:
+        yield conn
+        return
+    _mark_write()
+    callbacks = []
+    async with connection() as conn:
+        await conn.begin()
+        token = _transaction.set(conn)
+        callbacks_token = _after_commit.set(callbacks)
+        try:
+            yield conn
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            _after_commit.reset(callbacks_token)
+            _transaction.reset(token)
+    for fn in callbacks:
+        fn()
+
+# 在transaction()中时，fn()等事务提交之后再执行，回滚时不执行；不在事务中时立即执行。
+# 用于依赖已提交数据的后台任务，比如User.update()之后同步作者信息
+def after_commit(fn):
+    callbacks = _after_commit.get()
+    if callbacks is None:
+        fn()
+    else:
+        callbacks.append(fn)
+
+# 连接池状态，用来判断慢请求到底是慢在MySQL还是慢在等连接
+def pool_stats():
+    stats = dict(_pool_stats)
+    stats['avg_wait'] = stats['total_wait'] / stats['acquires'] if stats['acquires'] else 0.0
+    if __pool is not None:
+        stats['maxsize'] = __pool.maxsize
+        stats['size'] = __pool.size
+        stats['idle'] = __pool.freesize
+        stats['in_use'] = __pool.size - __pool.freesize
+    stats['replicas'] = [dict(size=p.size, idle=p.freesize, in_use=p.size - p.freesize, in_flight=n) for p, n in zip(__replicas, _replica_in_flight)]
+    now = time.time()
+    ages = [now - t for t in _conn_created.values()]
+    stats['max_conn_age'] = max(ages) if ages else 0.0
+    return stats
+
+# 已经见过的SQL形状 => 执行次数，只在配置了query_shapes_file时记录
+_query_shapes = dict()
+
+# 记录SQL形状，每种形状第一次出现时把SQL和这次的参数写入query_shapes_file，参数用来执行EXPLAIN
+def _record_shape(sql, args):
+    path = _pool_options['query_shapes_file']
+    if not path:
+        return
+    n = _query_shapes.get(sql)
+    _query_shapes[sql] = (n or 0) + 1
+    if n is None:
+        # 写文件放到默认线程池中，不阻塞事件循环
+        line = json.dumps(dict(sql=sql, args=list(args or ())), ensure_ascii=False, default=str) + '\n'
+        asyncio.get_event_loop().run_in_executor(None, _write_shape, path, line)
+
+def _write_shape(path, line):
+    try:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError as e:
+        logging.warning('failed to record query shape: %s' % e)
+
+def query_shapes():
+    return dict(_query_shapes)
+
 # 封装SQL SELECT语句为select函数
 async def select(sql, args, size=None):
+    # SQL语句的占位符为?，MySQL的占位符为%s
+    return await select_prepared(sql.replace('?','%s'), args, size)
+
+# sql已经是MySQL驱动可以直接执行的形式(占位符为%s)
+async def select_prepared(sql, args, size=None):
     log(sql,args)
-    global __pool
+    _record_shape(sql, args)
 
     # 这里与教程有了几处新的变化，协程中又调用很多子协程
     # -*- yield from 将会调用一个子协程，并直接返回调用的结果
-    # yield from/await从连接池中返回一个连接
-    async with __pool.get() as conn:
+    # yield from/await从连接池中返回一个连接，读操作可以交给从库
+    async with connection(readonly=True) as conn:
         # 原：cur = yield from conn.cursor(aiomysql.DictCursor)
         # DictCursor is a cursor which returns results as a dictionary
         # cur类似JDBC中的PreparedStatement
-        async with conn.cursor(aiomysql.DictCursor) as cur:		
+        async with conn.cursor(aiomysql.DictCursor) as cur:
             # 执行SQL语句
-            # SQL语句的占位符为?，MySQL的占位符为%s
-            await cur.execute(sql.replace('?','%s'), args or ())
+            await cur.execute(sql, args or ())
             # 根据指定返回的size，返回查询的结果
             if size:
                 # 返回size条查询结果
@@ -81,16 +323,35 @@ async def select(sql, args, size=None):
                 # 返回所有查询结果
                 rs = await cur.fetchall()
             logging.info('rows returned: %s' % len(rs))
-            #用完conn必须关闭，不然报RuntimeError: Event loop is closed
-            conn.close()
+            # 连接用完归还给连接池，不再每次都关闭(原来的conn.close()会让连接池每次都重新建立连接)
+            # 程序退出前调用destory_pool()关闭所有连接，就不会出现RuntimeError: Event loop is closed
             return rs
-			
+
+# 流式SELECT：用服务端游标(SSDictCursor)，每次从MySQL取batch_size行，逐行yield，
+# 结果集再大内存占用也是固定的。遍历期间一直占用一个连接，用完(或中途退出)后归还
+async def select_stream(sql, args, batch_size=1000):
+    log(sql,args)
+    _record_shape(sql, args)
+    async with connection(readonly=True) as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(sql, args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+
 # 封装INSERT, UPDATE, DELETE
 # 语句操作参数一样，所以定义一个通用的执行函数
 # 返回操作影响的行号
 async def execute(sql, args, autocommit=True):
     log(sql)
-    async with __pool.get() as conn:
+    _mark_write()
+    # 已经在transaction()中时，由外层负责提交
+    if _transaction.get() is not None:
+        autocommit = True
+    async with connection() as conn:
         if not autocommit:
             await conn.begin()
         try:
@@ -105,11 +366,50 @@ async def execute(sql, args, autocommit=True):
                 await conn.rollback()
             #错误向外抛
             raise
-        finally:
-            #防止event loop is closed错误，执行完SQL语句，要释放与数据库的连接。
-            conn.close()
         return affected
-	
+
+# 同一条SQL配多组参数，一个连接上用executemany执行完，返回总的影响行数
+async def execute_many(sql, args_list):
+    log(sql)
+    _mark_write()
+    async with connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(sql.replace('?','%s'), args_list)
+            return cur.rowcount
+
+# findNumber(cache=True)的结果缓存，在create_pool时根据count_ttl重建
+_count_cache = LRUCache(1024, ttl=60)
+# 每张表的写版本号，写操作时加1，旧版本的缓存条目就再也不会被读到，由LRU慢慢淘汰
+_table_versions = dict()
+
+# 直接用execute()修改表数据时，需要手动调用
+def invalidate_count(table):
+    _table_versions[table] = _table_versions.get(table, 0) + 1
+
+def count_cache_stats():
+    return _count_cache.stats()
+
+# 每个Model最多缓存多少条findAll的SQL
+_QUERY_CACHE_SIZE = 256
+
+# 把limit参数追加到args，返回limit的形式：None(没有limit)、1(limit n)、2(limit m, n)
+def _limit_shape(limit, args):
+    if limit is None:
+        return None
+    if isinstance(limit, int):
+        args.append(limit)
+        return 1
+    if isinstance(limit, tuple) and len(limit) == 2:
+        args.extend(limit)
+        return 2
+    raise ValueError('Invalid limit value: %s' % str(limit))
+
+# 把rows切成每批batch_size条，默认大小由create_pool的batch_size参数决定
+def _batches(rows, batch_size=None):
+    batch_size = batch_size or _pool_options['batch_size']
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
 # 根据输入的参数生成占位符列表
 def create_args_string(num):
     L = []
@@ -121,11 +421,13 @@ def create_args_string(num):
 # 定义Field类，负责保存(数据库)表的字段名和字段类型
 class Field(object):
     # 表的字段包含名字、类型、是否为表的主键和默认值
-    def __init__(self, name, column_type, primary_key, default):
+    # index=True表示给这一列建普通索引，index='unique'表示唯一索引，多列的组合索引在Model的__indexes__中声明
+    def __init__(self, name, column_type, primary_key, default, index=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
         
     # 打印输出(数据库)表的信息:类名，字段类型和名字
     def __str__(self):
@@ -135,28 +437,28 @@ class Field(object):
 # -*- 表的不同列的字段的类型不一样		
 class StringField(Field):
 	
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False):
+        super().__init__(name, ddl, primary_key, default, index)
 
 class BooleanField(Field):
 	
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class IntegerField(Field):
 	
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index)
 
 class FloatField(Field):
 	
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index)
 
 class TextField(Field):
 	
-    def __init__(self, name=None, primary_key=False, default=None):
-        super().__init__(name, 'text', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='text', index=False):
+        super().__init__(name, ddl, primary_key, default, index)
 
 # -*-定义Model的元类
  
@@ -230,6 +532,23 @@ class ModelMetaclass(type):
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        # findAll生成的SQL缓存
+        attrs['__query_cache__'] = dict()
+        # 索引定义__index_defs__：(索引名, 列名tuple, 是否唯一)，单列索引来自Field的index参数，
+        # 组合索引来自类属性__indexes__(保持声明时的样子)，例如
+        #     __indexes__ = [('blog_id', 'created_at')]
+        indexes = []
+        for k, v in mappings.items():
+            if v.index and not v.primary_key:
+                indexes.append(('idx_%s' % k, (k,), v.index == 'unique'))
+        for cols in attrs.get('__indexes__', ()):
+            indexes.append(('idx_%s' % '_'.join(cols), tuple(cols), False))
+        attrs['__index_defs__'] = indexes
+        # 建表和补建索引的DDL，用法见index_advisor.py
+        keys = ['    %skey `%s` (%s)' % ('unique ' if unique else '', n, ', '.join('`%s`' % c for c in cols)) for n, cols, unique in indexes]
+        columns = ['    `%s` %s not null' % (k, v.column_type) for k, v in mappings.items()]
+        attrs['__create_table__'] = 'create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (tableName, ',\n'.join(columns + keys + ['    primary key (`%s`)' % primaryKey]))
+        attrs['__create_indexes__'] = ['alter table `%s` add %skey `%s` (%s);' % (tableName, 'unique ' if unique else '', n, ', '.join('`%s`' % c for c in cols)) for n, cols, unique in indexes]
         return type.__new__(cls, name, bases, attrs)
 					
 # 定义ORM所有映射的基类：Model
@@ -276,35 +595,117 @@ class Model(dict, metaclass=ModelMetaclass):
     async def findAll(cls, where=None, args=None, **kw):
         # 根据WHERE条件查找
         ' find objects by where clause. '
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
+        args = list(args) if args else []
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        # 游标分页：keyset='created_at'指定排序列，desc=True为倒序，主键作为第二排序列保证顺序唯一，
+        # 排序由keyset生成，不能再传orderBy；after=(上一页最后一行keyset列的值, 主键)，只取排在它之后的行，
+        # 不管翻到第几页都只扫描limit行，不像limit m,n那样要先跳过m行
+        keyset = kw.get('keyset', None)
+        after = kw.get('after', None)
+        if keyset is None:
+            if after is not None:
+                raise ValueError('keyset is required when using after.')
+        else:
+            if orderBy:
+                raise ValueError('orderBy cannot be used with keyset.')
+            if keyset not in cls.__mappings__:
+                raise ValueError('Invalid keyset column %s for %s.' % (keyset, cls.__name__))
+            if after is not None:
+                if len(after) != 2:
+                    raise ValueError('Invalid after value: %s' % str(after))
+                args.extend([after[0], after[0], after[1]])
+            keyset = (keyset, bool(kw.get('desc', False)), after is not None)
         # select * from table limit m,n；指从第m+1条开始，取n条。
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
+        shape = _limit_shape(kw.get('limit', None), args)
+        # columns: 只查询这些列(主键总会查询)，列表页可以不取大的text列
+        columns = kw.get('columns', None)
+        rs = await select_prepared(cls._findAllSql(where, orderBy, shape, keyset, tuple(columns) if columns else None), args)
         return [cls(**r) for r in rs]
 
+    # 和findAll参数相同，但返回async迭代器，通过服务端游标逐行读取：
+    #     async for blog in Blog.findStream(orderBy='created_at desc', limit=(0, 10000)):
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findStream(cls, where=None, args=None, **kw):
+        ' iterate objects by where clause through a server-side cursor. '
+        args = list(args) if args else []
+        orderBy = kw.get('orderBy', None)
+        shape = _limit_shape(kw.get('limit', None), args)
+        async for r in select_stream(cls._findAllSql(where, orderBy, shape), args, kw.get('batch_size', 1000)):
+            yield cls(**r)
+
+    # 按主键顺序分批遍历整张表(或where筛选的部分)：
+    #     async for comment in Comment.iter_all(batch_size=500):
+    # 每批是一条独立的 pk > 上一批最后的pk ... limit batch_size 查询，内存里最多batch_size行，
+    # 批与批之间不占用连接，遍历过程中可以放心地修改数据(回填、重建索引等维护任务)
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch_size=1000):
+        ' iterate all objects by where clause in primary key order. '
+        pk = cls.__primary_key__
+        cond = '`%s` > ?' % pk
+        batch_where = '(%s) and %s' % (where, cond) if where else cond
+        rs = await cls.findAll(where, args, orderBy='`%s`' % pk, limit=batch_size)
+        while rs:
+            for r in rs:
+                yield r
+            if len(rs) < batch_size:
+                break
+            rs = await cls.findAll(batch_where, list(args or []) + [rs[-1][pk]], orderBy='`%s`' % pk, limit=batch_size)
+
+    # 同样的(where, orderBy, limit形式, 游标分页方式, 列)生成的SQL总是一样的，拼好、替换好占位符之后缓存在__query_cache__里
+    @classmethod
+    def _findAllSql(cls, where, orderBy, shape, keyset=None, columns=None):
+        key = (where, orderBy, shape, keyset, columns)
+        sql = cls.__query_cache__.get(key)
+        if sql is not None:
+            return sql
+        if columns:
+            for c in columns:
+                if c not in cls.__mappings__:
+                    raise ValueError('Invalid column %s for %s.' % (c, cls.__name__))
+            L = ['select `%s`, %s from `%s`' % (cls.__primary_key__, ', '.join('`%s`' % c for c in columns if c != cls.__primary_key__), cls.__table__)]
+        else:
+            L = [cls.__select__]
+        if keyset:
+            # keyset: (排序列, 是否倒序, 是否有after条件)
+            col, desc, has_after = keyset
+            if has_after:
+                op = '<' if desc else '>'
+                cond = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (col, op, col, cls.__primary_key__, op)
+                where = '(%s) and %s' % (where, cond) if where else cond
+            orderBy = '`%s` %s, `%s` %s' % (col, 'desc' if desc else 'asc', cls.__primary_key__, 'desc' if desc else 'asc')
+        if where:
+            L.append('where')
+            L.append(where)
+        if orderBy:
+            L.append('order by')
+            L.append(orderBy)
+        if shape == 1:
+            L.append('limit ?')
+        elif shape == 2:
+            L.append('limit ?, ?')
+        sql = ' '.join(L).replace('?', '%s')
+        # where一般是代码里写死的，数量有限；万一是动态拼出来的，缓存满了就不再缓存
+        if len(cls.__query_cache__) < _QUERY_CACHE_SIZE:
+            cls.__query_cache__[key] = sql
+        return sql
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, cache=False):
         # 根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL
+        # cache=True时结果缓存count_ttl秒，本进程内对这张表的写操作会让缓存失效
         ' find number by select and where. '
+        if cache:
+            key = (cls.__table__, _table_versions.get(cls.__table__, 0), selectField, where, tuple(args or ()))
+            num = _count_cache.get(key)
+            if num is not None:
+                return num
+            if _pool_options['approximate_count'] and not where and selectField.lower().startswith('count('):
+                num = await cls.estimateNumber()
+            else:
+                num = await cls.findNumber(selectField, where, args)
+            if num is not None:
+                _count_cache.set(key, num)
+            return num
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
@@ -314,6 +715,15 @@ class Model(dict, metaclass=ModelMetaclass):
             return None
         return rs[0]['_num_']
 
+    # InnoDB的count要扫描整个索引，表统计信息里的行数是估算值，但几乎不花时间
+    @classmethod
+    async def estimateNumber(cls):
+        ' estimate row count from table statistics. '
+        rs = await select('select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?', [cls.__table__], 1)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
     @classmethod
     async def find(cls, pk):
         # 通过类方法实现主键查找
@@ -329,6 +739,7 @@ class Model(dict, metaclass=ModelMetaclass):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = await execute(self.__insert__, args)
+        invalidate_count(self.__table__)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
@@ -336,14 +747,103 @@ class Model(dict, metaclass=ModelMetaclass):
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
+        invalidate_count(self.__table__)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        invalidate_count(self.__table__)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)					
+            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+
+    # 冗余列同步：本表中fk=source_id的行，把columns(列名 => 新值)中的列改成新值，例如作者改名后：
+    #     await Blog.refresh_columns('user_id', user.id, dict(user_name=user.name, user_image=user.image))
+    # 每批先按主键顺序选出最多batch_size个值不一致的行，再按主键更新，每条UPDATE只锁这一批行，不会长时间锁表；
+    # 批与批之间暂停pause秒，给线上的读写让路。已经一致的行不会再被选中，中断之后重跑就会从剩下的行继续，
+    # 也可以用after指定从哪个主键之后开始。返回更新的总行数
+    @classmethod
+    async def refresh_columns(cls, fk, source_id, columns, batch_size=None, pause=0.1, after=None):
+        ' copy columns into rows referencing source_id, in throttled primary key batches. '
+        pk = cls.__primary_key__
+        names = sorted(columns)
+        values = [columns[n] for n in names]
+        batch_size = batch_size or _pool_options['batch_size']
+        # <=>是NULL安全的等于
+        where = '`%s`=? and (%s) and `%s` > ?' % (fk, ' or '.join('not (`%s` <=> ?)' % n for n in names), pk)
+        select_sql = 'select `%s` from `%s` where %s order by `%s` limit ?' % (pk, cls.__table__, where, pk)
+        sets = ', '.join('`%s`=?' % n for n in names)
+        # 后台任务不在请求中，读也要走主库，否则从库的延迟会让刚更新过的行再被选中
+        token, route = begin_route(primary=True)
+        affected = 0
+        try:
+            while True:
+                rs = await select(select_sql, [source_id] + values + [after if after is not None else ''] + [batch_size])
+                if not rs:
+                    break
+                ids = [r[pk] for r in rs]
+                # 再带上fk条件，选出之后改了归属的行不会被误改
+                sql = 'update `%s` set %s where `%s` in (%s) and `%s`=?' % (cls.__table__, sets, pk, create_args_string(len(ids)), fk)
+                affected = affected + await execute(sql, values + ids + [source_id])
+                after = ids[-1]
+                logging.info('refresh %s.%s for %s=%s: %s rows, last %s: %s' % (cls.__table__, ','.join(names), fk, source_id, affected, pk, after))
+                if len(ids) < batch_size:
+                    break
+                if pause:
+                    await asyncio.sleep(pause)
+        finally:
+            end_route(token)
+        return affected
+
+    # 批量增，改，删：按batch_size分批，每批只占用一个连接、一次往返，返回总的影响行数
+    @classmethod
+    async def save_many(cls, rows, batch_size=None):
+        ' insert rows with multi-row INSERT. '
+        rows = list(rows)
+        affected = 0
+        for batch in _batches(rows, batch_size):
+            args = []
+            for r in batch:
+                args.extend(map(r.getValueOrDefault, cls.__fields__))
+                args.append(r.getValueOrDefault(cls.__primary_key__))
+            # insert into t (...) values (?,?), (?,?), ...
+            values = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+            sql = '%s values %s' % (cls.__insert__[:cls.__insert__.rindex(' values ')], ', '.join([values] * len(batch)))
+            affected = affected + await execute(sql, args)
+        invalidate_count(cls.__table__)
+        if affected != len(rows):
+            logging.warn('failed to insert records: affected rows: %s of %s' % (affected, len(rows)))
+        return affected
+
+    @classmethod
+    async def update_many(cls, rows, batch_size=None):
+        ' update rows by primary key with executemany. '
+        rows = list(rows)
+        affected = 0
+        for batch in _batches(rows, batch_size):
+            args = []
+            for r in batch:
+                a = list(map(r.getValue, cls.__fields__))
+                a.append(r.getValue(cls.__primary_key__))
+                args.append(a)
+            affected = affected + await execute_many(cls.__update__, args)
+        invalidate_count(cls.__table__)
+        return affected
+
+    @classmethod
+    async def remove_many(cls, rows, batch_size=None):
+        ' delete rows by primary key with DELETE ... IN (...). '
+        rows = list(rows)
+        affected = 0
+        for batch in _batches(rows, batch_size):
+            args = [r.getValue(cls.__primary_key__) for r in batch]
+            sql = 'delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(args)))
+            affected = affected + await execute(sql, args)
+        invalidate_count(cls.__table__)
+        if affected != len(rows):
+            logging.warn('failed to remove records: affected rows: %s of %s' % (affected, len(rows)))
+        return affected
 					
 #测试
 '''
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+页面缓存
+
+1. 整页缓存：匿名用户看到的首页、日志页都一样，用@get('/', cache=60, tags=('blogs',))声明后，
+   page_cache_factory(见app.py)把渲染好的body按(路由, 查询参数, 用户类型)缓存，命中时不访问MySQL也不渲染Jinja2；
+2. 片段缓存：模板中用{% cache 'name', 300, 'tag' %}...{% endcache %}缓存开销大的片段，登录用户也能受益。
+
+失效用标签：每个标签有一个版本号，写操作调用invalidate(tag)让版本号加1，
+带这个标签的缓存条目的key随之改变，再也不会被读到，由LRU慢慢淘汰。标签中可以用{id}引用URL参数。
+'''
+
+import logging
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import LRUCache
+from config import configs
+
+_CACHE_CONFIG = configs.get('cache', {})
+
+_page_cache = LRUCache(_CACHE_CONFIG.get('page_size', 1024), ttl=_CACHE_CONFIG.get('page_ttl', 60))
+_fragment_cache = LRUCache(_CACHE_CONFIG.get('fragment_size', 1024), ttl=_CACHE_CONFIG.get('fragment_ttl', 300))
+
+_tag_versions = dict()
+
+# 博客、评论等数据修改后调用，例如invalidate('blogs', 'blog:%s' % blog.id)
+def invalidate(*tags):
+    for tag in tags:
+        _tag_versions[tag] = _tag_versions.get(tag, 0) + 1
+    logging.info('invalidate page cache: %s' % ', '.join(tags))
+
+def _versions(tags):
+    return tuple(_tag_versions.get(tag, 0) for tag in tags)
+
+# 整页缓存的key，tags中的{name}用URL参数替换
+def page_key(request, user_class, tags):
+    tags = [tag.format(**request.match_info) for tag in tags]
+    return (request.path, request.query_string, user_class, _versions(tags))
+
+def get_page(key):
+    return _page_cache.get(key)
+
+def set_page(key, page, ttl=None):
+    _page_cache.set(key, page, ttl)
+
+def stats():
+    return dict(page=_page_cache.stats(), fragment=_fragment_cache.stats())
+
+class FragmentCacheExtension(Extension):
+    '''
+    Jinja2 tag: {% cache name, ttl, tag1, tag2 %}...{% endcache %}
+    '''
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, args, caller):
+        name = args[0]
+        ttl = args[1] if len(args) > 1 else None
+        tags = args[2:]
+        key = (name, _versions(tags))
+        rv = _fragment_cache.get(key)
+        if rv is None:
+            rv = caller()
+            _fragment_cache.set(key, rv, ttl)
+        return rv
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+同步blogs、comments中冗余的作者信息
+
+User.update()会在后台同步单个用户，这个脚本用来补上直接改库、后台任务中断等情况留下的旧数据：
+    python refresh_authors.py [batch_size] [pause] [after_user_id]
+
+按用户id顺序处理，每个用户的同步见orm.Model.refresh_columns：分批更新、批间暂停，已经一致的行不会再处理。
+中途中断可以直接重跑，或者用日志里最后完成的用户id作为after_user_id继续。
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import sys, time, asyncio
+
+import orm
+from models import User, refresh_author
+from config import configs
+
+async def refresh_all(loop, batch_size=None, pause=0.1, after=None):
+    await orm.create_pool(loop=loop, **configs.db)
+    start = time.time()
+    users = blogs = comments = 0
+    where, args = ('`id` > ?', [after]) if after else (None, None)
+    async for user in User.iter_all(where, args):
+        b, c = await refresh_author(user, batch_size, pause)
+        users = users + 1
+        blogs = blogs + b
+        comments = comments + c
+        logging.info('user done: %s' % user.id)
+    await orm.destory_pool()
+    logging.info('refresh done: %s users, %s blogs, %s comments in %.1f seconds.' % (users, blogs, comments, time.time() - start))
+
+if __name__ == '__main__':
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    pause = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    after = sys.argv[3] if len(sys.argv) > 3 else None
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(refresh_all(loop, batch_size, pause, after))
+    loop.close()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+Markdown渲染
+
+get_blog每次访问都要调用markdown2.markdown()，对热门文章来说这是每个请求最大的CPU开销。
+这里把渲染结果放进LRUCache，key是 正文 + 渲染选项 的sha1，正文不变就直接返回缓存的html。
+
+渲染是纯CPU操作，在事件循环里直接跑大文章会卡住所有连接。markdown_async()对超过inline_threshold的正文，
+把渲染交给线程池或进程池(由configs.markdown.executor决定)，小文章仍然直接渲染，省掉调度开销。
+'''
+
+import asyncio, hashlib, json, logging, time
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import markdown2
+
+from cache import LRUCache
+from config import configs
+
+_MARKDOWN_CONFIG = configs.get('markdown', {})
+
+# 全局的渲染结果缓存，可以通过set_cache_backend()接入外部存储
+_html_cache = LRUCache(_MARKDOWN_CONFIG.get('cache_size', 256))
+
+def set_cache_backend(backend):
+    _html_cache.backend = backend
+
+def cache_stats():
+    return _html_cache.stats()
+
+# 渲染选项也要参与计算key，同一篇正文用不同的extras渲染结果是不同的
+def _cache_key(text, options):
+    h = hashlib.sha1(text.encode('utf-8'))
+    h.update(b'\0')
+    h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+    return 'md:%s' % h.hexdigest()
+
+# text->html，带缓存
+def markdown(text, **options):
+    if not text:
+        return ''
+    key = _cache_key(text, options)
+    html = _html_cache.get(key)
+    if html is None:
+        html = markdown2.markdown(text, **options)
+        _html_cache.set(key, html)
+    return html
+
+# 进程池中执行的渲染函数，必须是模块级函数才能被pickle
+def _render(text, options):
+    return markdown2.markdown(text, **options)
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        kind = _MARKDOWN_CONFIG.get('executor', 'thread')
+        size = _MARKDOWN_CONFIG.get('executor_size', 4)
+        logging.info('create markdown %s executor, size: %s' % (kind, size))
+        if kind == 'process':
+            _executor = ProcessPoolExecutor(size)
+        elif kind == 'thread':
+            _executor = ThreadPoolExecutor(size)
+        else:
+            raise ValueError('Invalid markdown executor: %s' % kind)
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+# 交给executor渲染的统计：当前排队/执行中的数量，总次数，总耗时和最大耗时(秒)
+_executor_stats = dict(pending=0, max_pending=0, count=0, total_time=0.0, max_time=0.0)
+
+def executor_stats():
+    stats = dict(_executor_stats)
+    stats['avg_time'] = stats['total_time'] / stats['count'] if stats['count'] else 0.0
+    return stats
+
+# 异步版本的markdown()，大文章不在事件循环里渲染
+async def markdown_async(text, **options):
+    if not text:
+        return ''
+    if len(text) < _MARKDOWN_CONFIG.get('inline_threshold', 16384):
+        return markdown(text, **options)
+    key = _cache_key(text, options)
+    html = _html_cache.get(key)
+    if html is not None:
+        return html
+    stats = _executor_stats
+    stats['pending'] = stats['pending'] + 1
+    stats['max_pending'] = max(stats['max_pending'], stats['pending'])
+    start = time.time()
+    try:
+        html = await asyncio.get_event_loop().run_in_executor(get_executor(), _render, text, options)
+    finally:
+        t = time.time() - start
+        stats['pending'] = stats['pending'] - 1
+        stats['count'] = stats['count'] + 1
+        stats['total_time'] = stats['total_time'] + t
+        stats['max_time'] = max(stats['max_time'], t)
+    logging.info('markdown rendered off-loop: %s chars in %.1f ms' % (len(text), t * 1000))
+    _html_cache.set(key, html)
+    return html
+
+# 博文修改或删除时调用，把旧正文对应的缓存清掉
+def invalidate(text, **options):
+    if not text:
+        return
+    logging.info('invalidate markdown cache.')
+    _html_cache.delete(_cache_key(text, options))
+
+# 简单的性能对比：python renderer.py
+if __name__ == '__main__':
+    import timeit
+    text = '# title\n\nsome *markdown* text with a [link](http://example.com).\n\n    code block\n\n* item 1\n* item 2\n'
+    n = 2000
+    t1 = timeit.timeit(lambda: markdown2.markdown(text), number=n)
+    t2 = timeit.timeit(lambda: markdown(text), number=n)
+    print('markdown2.markdown(): %.1f us/call' % (t1 / n * 1e6))
+    print('renderer.markdown(): %.1f us/call (%s)' % (t2 / n * 1e6, cache_stats()))
@@ -29,7 +29,9 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
     `created_at` real not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -42,6 +44,8 @@ create table comments (
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试apis.py中的分页和游标，同时运行apis.py中的doctest
+'''
+
+import doctest, unittest
+
+import apis
+
+from apis import CursorPage, APIValueError, encode_cursor, decode_cursor
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(apis))
+    return tests
+
+class TestCursor(unittest.TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor(1500000000.123, '0015000000000abc000')
+        # urlsafe，不带=，可以直接放进URL
+        self.assertNotIn('=', cursor)
+        self.assertNotIn('/', cursor)
+        self.assertEqual(decode_cursor(cursor), (1500000000.123, '0015000000000abc000'))
+
+    def test_invalid_cursor(self):
+        for cursor in ('not-a-cursor', encode_cursor(1.0, 'a')[:-2], 'W10'):
+            with self.assertRaises(APIValueError):
+                decode_cursor(cursor)
+
+    def test_last_page(self):
+        p = CursorPage('', 3)
+        items = p.paginate([dict(created_at=2.0, id='b'), dict(created_at=1.0, id='a')])
+        self.assertEqual(len(items), 2)
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.next_cursor, '')
+
+    def test_next_cursor_points_at_last_item(self):
+        p = CursorPage('', 2)
+        rows = [dict(created_at=float(t), id=str(t)) for t in (5, 4, 3)]
+        items = p.paginate(rows)
+        self.assertEqual([r['id'] for r in items], ['5', '4'])
+        self.assertEqual(CursorPage(p.next_cursor, 2).after, (4.0, '4'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试cache.LRUCache，在www目录下运行：python -m unittest
+'''
+
+import time, unittest
+
+from cache import LRUCache
+
+class DictBackend(object):
+
+    def __init__(self):
+        self.data = dict()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_invalid_maxsize(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        # 读a之后，最久未使用的是b
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertNotIn('b', c)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.stats()['evictions'], 1)
+
+    def test_hits_and_misses(self):
+        c = LRUCache(4)
+        c.set('a', 1)
+        c.get('a')
+        self.assertIsNone(c.get('x'))
+        self.assertEqual(c.get('x', 0), 0)
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 1 / 3)
+
+    def test_ttl_expires(self):
+        c = LRUCache(4, ttl=0.05)
+        c.set('a', 1)
+        # 单个条目的ttl覆盖默认值
+        c.set('b', 2, ttl=60)
+        self.assertEqual(c.get('a'), 1)
+        time.sleep(0.06)
+        self.assertIsNone(c.get('a'))
+        self.assertNotIn('a', c)
+        self.assertEqual(c.get('b'), 2)
+        self.assertEqual(c.stats()['expirations'], 1)
+
+    def test_delete_and_clear(self):
+        c = LRUCache(4)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.delete('a')
+        c.delete('missing')
+        self.assertNotIn('a', c)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_backend(self):
+        backend = DictBackend()
+        c = LRUCache(1, backend=backend)
+        c.set('a', 1)
+        c.set('b', 2)
+        # a已经被本地淘汰，从backend读回
+        self.assertNotIn('a', c)
+        self.assertEqual(c.get('a'), 1)
+        self.assertIn('a', c)
+        c.delete('a')
+        self.assertNotIn('a', backend.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试compress.py中Accept-Encoding的协商
+'''
+
+import gzip, unittest
+
+import compress
+
+from compress import choose_encoding, compressible, add_vary, weak_etag
+
+class TestChooseEncoding(unittest.TestCase):
+
+    def test_basic(self):
+        self.assertIsNone(choose_encoding(None))
+        self.assertIsNone(choose_encoding(''))
+        self.assertIsNone(choose_encoding('identity'))
+        self.assertEqual(choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(choose_encoding('GZIP;q=0.5'), 'gzip')
+
+    def test_q_zero_is_refused(self):
+        self.assertIsNone(choose_encoding('gzip;q=0'))
+        self.assertIsNone(choose_encoding('gzip;q=0.0, deflate'))
+
+    def test_q_zero_wins_over_wildcard(self):
+        self.assertIsNone(choose_encoding('gzip;q=0, *'))
+        self.assertEqual(choose_encoding('*'), 'gzip')
+        self.assertIsNone(choose_encoding('*;q=0'))
+
+    def test_candidates(self):
+        self.assertEqual(choose_encoding('gzip, br', ['br', 'gzip']), 'br')
+        self.assertEqual(choose_encoding('br;q=0, gzip', ['br', 'gzip']), 'gzip')
+        self.assertEqual(choose_encoding('br;q=0, *', ['br', 'gzip']), 'gzip')
+        self.assertIsNone(choose_encoding('br', ['gzip']))
+
+class TestHelpers(unittest.TestCase):
+
+    def test_compressible(self):
+        self.assertTrue(compressible('text/html', 4096))
+        self.assertFalse(compressible('text/html', 10))
+        self.assertFalse(compressible('image/png', 4096))
+
+    def test_compress_gzip(self):
+        data = b'hello ' * 1000
+        self.assertEqual(gzip.decompress(compress.compress(data, 'gzip')), data)
+
+    def test_add_vary(self):
+        headers = dict()
+        add_vary(headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        add_vary(headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        headers = dict(Vary='Cookie')
+        add_vary(headers)
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_weak_etag(self):
+        self.assertEqual(weak_etag('"abc"'), 'W/"abc"')
+        self.assertEqual(weak_etag('W/"abc"'), 'W/"abc"')
+
+if __name__ == '__main__':
+    unittest.main()
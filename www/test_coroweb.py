@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试coroweb.py：RequestHandler的参数绑定、条件GET、Range解析和StaticHandler
+'''
+
+import gzip, os, shutil, tempfile, unittest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import coroweb
+
+from coroweb import RequestHandler, StaticHandler, parse_range, compute_etag, etag_matches, is_not_modified, get_auth_level, AUTH_PUBLIC, AUTH_USER, AUTH_ADMIN
+from apis import APIValueError
+
+# POST请求需要body，make_mocked_request不方便构造，这里只提供RequestHandler用到的属性
+class JsonRequest(object):
+
+    def __init__(self, body, match_info=None, content_type='application/json'):
+        self.method = 'POST'
+        self.content_type = content_type
+        self.match_info = match_info or {}
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+async def kw_only(*, page='1', size):
+    return dict(page=page, size=size)
+
+async def with_request(id, request, *, content):
+    return dict(id=id, request=request, content=content)
+
+async def var_kw(**kw):
+    return kw
+
+async def no_args():
+    return 'ok'
+
+async def raises():
+    raise APIValueError('name', 'bad name')
+
+class TestRequestHandler(unittest.IsolatedAsyncioTestCase):
+
+    def test_plan(self):
+        h = RequestHandler(None, kw_only)
+        self.assertTrue(h._wants_params)
+        self.assertEqual(set(h._select_kw_args), set(['page', 'size']))
+        h = RequestHandler(None, var_kw)
+        self.assertIsNone(h._select_kw_args)
+        self.assertFalse(RequestHandler(None, no_args)._wants_params)
+
+    async def test_get_selects_named_args(self):
+        r = await RequestHandler(None, kw_only)(make_mocked_request('GET', '/x?size=5&other=1'))
+        self.assertEqual(r, dict(page='1', size='5'))
+
+    async def test_get_missing_required(self):
+        r = await RequestHandler(None, kw_only)(make_mocked_request('GET', '/x?page=2'))
+        self.assertIsInstance(r, web.HTTPBadRequest)
+
+    async def test_var_kw_keeps_everything(self):
+        r = await RequestHandler(None, var_kw)(make_mocked_request('GET', '/x?a=1&b=2', match_info=dict(id='9')))
+        self.assertEqual(r, dict(a='1', b='2', id='9'))
+
+    async def test_post_json_with_match_info_and_request(self):
+        request = JsonRequest(dict(content='hi', extra='x'), match_info=dict(id='b1'))
+        r = await RequestHandler(None, with_request)(request)
+        self.assertEqual(r, dict(id='b1', request=request, content='hi'))
+
+    async def test_post_rejects_bad_body(self):
+        h = RequestHandler(None, with_request)
+        self.assertIsInstance(await h(JsonRequest([1, 2])), web.HTTPBadRequest)
+        self.assertIsInstance(await h(JsonRequest({}, content_type='text/plain')), web.HTTPBadRequest)
+
+    async def test_api_error(self):
+        r = await RequestHandler(None, raises)(make_mocked_request('GET', '/x'))
+        self.assertEqual(r, dict(error='value:invalid', data='name', message='bad name'))
+
+    def test_auth_level(self):
+        self.assertEqual(get_auth_level(kw_only), AUTH_PUBLIC)
+        self.assertEqual(get_auth_level(with_request), AUTH_USER)
+        self.assertEqual(get_auth_level(coroweb.get('/manage/x')(no_args)), AUTH_ADMIN)
+        self.assertEqual(get_auth_level(coroweb.get('/x', auth=AUTH_ADMIN)(kw_only)), AUTH_ADMIN)
+
+class TestConditional(unittest.TestCase):
+
+    def test_etag_matches(self):
+        etag = compute_etag(b'body')
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches('"other", ' + etag, etag))
+        # 忽略弱校验前缀
+        self.assertTrue(etag_matches('W/' + etag, etag))
+        self.assertTrue(etag_matches(etag, 'W/' + etag))
+        self.assertTrue(etag_matches('*', etag))
+        self.assertFalse(etag_matches('"other"', etag))
+
+    def test_is_not_modified(self):
+        etag = compute_etag(b'body')
+        self.assertTrue(is_not_modified(make_mocked_request('GET', '/', headers={'If-None-Match': etag}), etag))
+        self.assertFalse(is_not_modified(make_mocked_request('GET', '/', headers={'If-None-Match': '"x"'}), etag))
+        self.assertFalse(is_not_modified(make_mocked_request('GET', '/'), etag))
+
+class TestParseRange(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(parse_range('bytes=0-4', 10), (0, 4))
+        self.assertEqual(parse_range('bytes=3-', 10), (3, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=-30', 10), (0, 9))
+        self.assertEqual(parse_range('bytes=5-100', 10), (5, 9))
+
+    def test_invalid_is_ignored(self):
+        for header in ('bytes=5-3', 'items=0-1', 'bytes=x-1', 'bytes=0-1,3-4', 'bytes=5'):
+            self.assertIsNone(parse_range(header, 10), header)
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=10-', 'bytes=20-30', 'bytes=-0'):
+            self.assertIs(parse_range(header, 10), False, header)
+
+class TestStaticHandler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.js = b'var x = 1;\n' * 200
+        self._write('a.js', self.js)
+        self._write('b.css', b'body{}' * 100)
+        self._write('b.css.br', b'fake brotli')
+        self._write('c.png', b'\x89PNG' * 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def _get(self, name, headers=None):
+        return make_mocked_request('GET', '/static/' + name, headers=headers or {}, match_info=dict(filename=name))
+
+    async def test_memory_identity(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('a.js'))
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.body, self.js)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+
+    async def test_memory_gzip_variant(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('a.js', {'Accept-Encoding': 'gzip, deflate'}))
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.body), self.js)
+        # 压缩版本有自己的ETag
+        identity = await h(self._get('a.js'))
+        self.assertNotEqual(resp.headers['ETag'], identity.headers['ETag'])
+
+    async def test_refused_encoding(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('a.js', {'Accept-Encoding': 'gzip;q=0, *'}))
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = await h(self._get('b.css', {'Accept-Encoding': 'br;q=0, gzip'}))
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    async def test_existing_br_variant(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('b.css', {'Accept-Encoding': 'gzip, br'}))
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.body, b'fake brotli')
+        self.assertTrue(resp.content_type.startswith('text/css'))
+
+    async def test_not_compressible(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('c.png', {'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    async def test_not_modified(self):
+        h = StaticHandler(self.root, memory=True)
+        etag = (await h(self._get('a.js'))).headers['ETag']
+        resp = await h(self._get('a.js', {'If-None-Match': etag}))
+        self.assertEqual(resp.status, 304)
+
+    async def test_range(self):
+        h = StaticHandler(self.root, memory=True)
+        resp = await h(self._get('a.js', {'Range': 'bytes=0-9', 'Accept-Encoding': 'gzip'}))
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.body, self.js[:10])
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 0-9/%s' % len(self.js))
+        # 带Range时总是发送原文件
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = await h(self._get('a.js', {'Range': 'bytes=%s-' % len(self.js)}))
+        self.assertEqual(resp.status, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */%s' % len(self.js))
+        resp = await h(self._get('a.js', {'Range': 'bytes=9-3'}))
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.body, self.js)
+
+    async def test_disk_mode_uses_file_response(self):
+        h = StaticHandler(self.root)
+        resp = await h(self._get('b.css', {'Accept-Encoding': 'br'}))
+        self.assertIsInstance(resp, web.FileResponse)
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+
+    async def test_not_found(self):
+        h = StaticHandler(self.root, memory=True)
+        for name in ('missing.js', '../etc/passwd'):
+            with self.assertRaises(web.HTTPNotFound):
+                await h(self._get(name))
+
+if __name__ == '__main__':
+    unittest.main()
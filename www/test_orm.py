@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试orm.py：findAll生成的SQL(包括游标分页)、事务的提交和回滚。
+不需要MySQL，用一个假的连接池记录执行过的SQL。
+'''
+
+import asyncio, unittest
+
+import orm
+
+from models import Blog, Comment
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, sql, args=None):
+        self.conn.log.append((sql, list(args or ())))
+        self.rowcount = 1
+
+    async def fetchall(self):
+        return []
+
+    async def fetchmany(self, size):
+        return []
+
+class FakeConnection(object):
+
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self, *args):
+        return FakeCursor(self)
+
+    async def begin(self):
+        self.log.append('begin')
+
+    async def commit(self):
+        self.log.append('commit')
+
+    async def rollback(self):
+        self.log.append('rollback')
+
+    async def ping(self, reconnect):
+        pass
+
+class FakePool(object):
+
+    def __init__(self):
+        self.log = []
+        self.acquired = 0
+        self.released = 0
+
+    async def acquire(self):
+        self.acquired = self.acquired + 1
+        return FakeConnection(self.log)
+
+    def release(self, conn):
+        self.released = self.released + 1
+
+class TestFindAllSql(unittest.TestCase):
+
+    def test_plain(self):
+        sql = Blog._findAllSql('`user_id`=?', 'created_at desc', 2)
+        self.assertEqual(sql, Blog.__select__ + ' where `user_id`=%s order by created_at desc limit %s, %s')
+        # 同样的形状直接用缓存
+        self.assertIs(Blog._findAllSql('`user_id`=?', 'created_at desc', 2), sql)
+
+    def test_columns(self):
+        sql = Blog._findAllSql(None, None, 1, columns=('name', 'created_at'))
+        self.assertEqual(sql, 'select `id`, `name`, `created_at` from `blogs` limit %s')
+        with self.assertRaises(ValueError):
+            Blog._findAllSql(None, None, None, columns=('nope',))
+
+    def test_keyset_first_page(self):
+        sql = Blog._findAllSql(None, None, 1, ('created_at', True, False))
+        self.assertTrue(sql.endswith('from `blogs` order by `created_at` desc, `id` desc limit %s'))
+
+    def test_keyset_after_desc(self):
+        sql = Blog._findAllSql('`user_id`=?', None, 1, ('created_at', True, True))
+        self.assertIn('where (`user_id`=%s) and (`created_at` < %s or (`created_at` = %s and `id` < %s))', sql)
+        self.assertTrue(sql.endswith('order by `created_at` desc, `id` desc limit %s'))
+
+    def test_keyset_after_asc(self):
+        sql = Blog._findAllSql(None, None, 1, ('created_at', False, True))
+        self.assertIn('where (`created_at` > %s or (`created_at` = %s and `id` > %s))', sql)
+        self.assertTrue(sql.endswith('order by `created_at` asc, `id` asc limit %s'))
+
+class TestFindAll(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.calls = []
+        self._select_prepared = orm.select_prepared
+        async def select_prepared(sql, args, size=None):
+            self.calls.append((sql, args))
+            return []
+        orm.select_prepared = select_prepared
+
+    async def asyncTearDown(self):
+        orm.select_prepared = self._select_prepared
+
+    async def test_keyset_args(self):
+        await Blog.findAll('`user_id`=?', ['u1'], keyset='created_at', desc=True, after=(2.0, 'b'), limit=10)
+        sql, args = self.calls[0]
+        self.assertEqual(args, ['u1', 2.0, 2.0, 'b', 10])
+        self.assertEqual(sql, Blog._findAllSql('`user_id`=?', None, 1, ('created_at', True, True)))
+
+    async def test_keyset_errors(self):
+        with self.assertRaises(ValueError):
+            await Blog.findAll(after=(2.0, 'b'))
+        with self.assertRaises(ValueError):
+            await Blog.findAll(keyset='created_at', orderBy='created_at desc')
+        with self.assertRaises(ValueError):
+            await Blog.findAll(keyset='nope')
+        with self.assertRaises(ValueError):
+            await Blog.findAll(keyset='created_at', after=(1.0,))
+
+class TestTransaction(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pool = FakePool()
+        self._pool = getattr(orm, '__pool')
+        setattr(orm, '__pool', self.pool)
+
+    async def asyncTearDown(self):
+        setattr(orm, '__pool', self._pool)
+
+    async def test_commit(self):
+        async with orm.transaction():
+            await orm.execute('delete from `comments` where `blog_id`=?', ['b1'])
+            await orm.execute('delete from `blogs` where `id`=?', ['b1'])
+        log = self.pool.log
+        self.assertEqual(log[0], 'begin')
+        self.assertEqual(log[-1], 'commit')
+        self.assertEqual(len(log), 4)
+        # 事务中的语句共用一个连接
+        self.assertEqual((self.pool.acquired, self.pool.released), (1, 1))
+
+    async def test_rollback(self):
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                await orm.execute('delete from `blogs` where `id`=?', ['b1'])
+                raise ValueError('boom')
+        self.assertEqual(self.pool.log[-1], 'rollback')
+        self.assertNotIn('commit', self.pool.log)
+        self.assertEqual(self.pool.released, 1)
+        self.assertIsNone(orm._transaction.get())
+
+    async def test_nested(self):
+        async with orm.transaction():
+            async with orm.transaction():
+                await orm.execute('delete from `blogs` where `id`=?', ['b1'])
+        self.assertEqual(self.pool.log.count('begin'), 1)
+        self.assertEqual(self.pool.log.count('commit'), 1)
+
+    async def test_after_commit(self):
+        called = []
+        async with orm.transaction():
+            orm.after_commit(lambda: called.append('committed'))
+            self.assertEqual(called, [])
+        self.assertEqual(called, ['committed'])
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                orm.after_commit(lambda: called.append('rolled back'))
+                raise ValueError('boom')
+        self.assertEqual(called, ['committed'])
+        # 不在事务中时立即执行
+        orm.after_commit(lambda: called.append('now'))
+        self.assertEqual(called, ['committed', 'now'])
+
+class TestIndexes(unittest.TestCase):
+
+    def test_index_defs(self):
+        self.assertEqual(Comment.__indexes__, [('blog_id', 'created_at')])
+        self.assertIn(('idx_blog_id_created_at', ('blog_id', 'created_at'), False), Comment.__index_defs__)
+        self.assertIn('key `idx_blog_id_created_at` (`blog_id`, `created_at`)', Comment.__create_table__)
+
+if __name__ == '__main__':
+    unittest.main()
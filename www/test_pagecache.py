@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Song-Xiangming'
+
+'''
+测试pagecache.py：整页缓存的key、标签失效和模板片段缓存
+'''
+
+import unittest
+
+from aiohttp.test_utils import make_mocked_request
+from jinja2 import Environment
+
+import pagecache
+
+from pagecache import FragmentCacheExtension
+
+class TestPageCache(unittest.TestCase):
+
+    def _request(self, path, match_info=None):
+        return make_mocked_request('GET', path, match_info=match_info or {})
+
+    def test_key_depends_on_query_and_user_class(self):
+        r1 = self._request('/?page=1')
+        r2 = self._request('/?page=2')
+        self.assertNotEqual(pagecache.page_key(r1, 'anonymous', ('blogs',)), pagecache.page_key(r2, 'anonymous', ('blogs',)))
+        self.assertNotEqual(pagecache.page_key(r1, 'anonymous', ('blogs',)), pagecache.page_key(r1, 'user', ('blogs',)))
+
+    def test_invalidate_tag(self):
+        request = self._request('/blog/t1', dict(id='t1'))
+        key = pagecache.page_key(request, 'anonymous', ('blog:{id}',))
+        pagecache.set_page(key, (b'<html>', 'text/html', '"e"'))
+        self.assertEqual(pagecache.get_page(pagecache.page_key(request, 'anonymous', ('blog:{id}',))), (b'<html>', 'text/html', '"e"'))
+        # 别的日志失效不影响这一页
+        pagecache.invalidate('blog:t2')
+        self.assertIsNotNone(pagecache.get_page(pagecache.page_key(request, 'anonymous', ('blog:{id}',))))
+        pagecache.invalidate('blog:t1')
+        self.assertIsNone(pagecache.get_page(pagecache.page_key(request, 'anonymous', ('blog:{id}',))))
+
+    def test_fragment(self):
+        env = Environment(extensions=[FragmentCacheExtension])
+        t = env.from_string("{% cache 'test-fragment', 60, 'fragment-tag' %}{{ n }}{% endcache %}")
+        self.assertEqual(t.render(n=1), '1')
+        # 命中缓存，不再渲染
+        self.assertEqual(t.render(n=2), '1')
+        pagecache.invalidate('fragment-tag')
+        self.assertEqual(t.render(n=3), '3')
+
+if __name__ == '__main__':
+    unittest.main()